@@ -0,0 +1,64 @@
+import numpy as np
+import sys
+
+def VHD_lines(n_rows, n_sections=3, B_max=20000., seed=0):
+    """Lines of a synthetic Lakeshore VHD file with n_rows data rows.
+
+    The file has a column table, an image correction table and a data block
+    with n_sections sections. B runs through virgin curve and full hysteresis
+    loops in Oe, the signal is a noisy Langevin-like curve in emu.
+    """
+    rng = np.random.default_rng(seed)
+    lines = ["#Lakeshore 7400 VSM data file (synthetic benchmark data)",
+             "#File created: 2017-11-27 12:54:28",
+             "@Measurement Setup",
+             "Sample: benchmark",
+             "Averaging Time [sec]: 0.1",
+             "@Column Contents:"]
+    columns = ["Time Stamp [sec]", "Applied Field [Oe]", "Field Status",
+               "Raw Signal Mx [emu]", "Raw Signal My [emu]",
+               "Moment [emu]", "Temperature [K]"]
+    for icolumn, column in enumerate(columns):
+        lines.append("Column " + str(icolumn + 1) + ": " + column)
+    lines += ["@@END Columns", "",
+              "Image Correction",
+              "#Field [Oe]\tFactor"]
+    for B_corr, factor in zip(np.linspace(0, 1.1*B_max, 12),\
+                              np.linspace(1., 1.08, 12)):
+        lines.append("%g\t%.5f" % (B_corr, factor))
+    lines += ["", "@@Data"]
+
+    # virgin curve 0 -> B_max, then loops B_max -> -B_max -> B_max
+    phase = np.linspace(0., 0.25 + np.ceil(n_rows/4000.), n_rows)
+    B = B_max*np.sin(2*np.pi*phase)
+    M = 1e-3*np.tanh(B/3000.) + 1e-6*rng.normal(size=n_rows)
+    data = np.column_stack((0.1*np.arange(n_rows), B, np.ones(n_rows),\
+                            M, 1e-6*rng.normal(size=n_rows), M,\
+                            300. + 0.01*rng.normal(size=n_rows)))
+    row_format = "%.3f\t%.6f\t%d\t%.8e\t%.8e\t%.8e\t%.4f\n"
+    for isection, section in enumerate(np.array_split(data, n_sections)):
+        lines.append("New Section: Section " + str(isection + 1) + ": ")
+        rows = (row_format*len(section)) % tuple(section.ravel().tolist())
+        lines += rows.splitlines()
+    lines += ["@@END Data.", "@@Final Manual Data", "Operator: benchmark"]
+    return lines
+
+def write_VHD_file(filepath, n_rows, n_sections=3, crlf=False, seed=0):
+    newline = "\r\n" if crlf else "\n"
+    lines = VHD_lines(n_rows, n_sections, seed=seed)
+    vhd_file = open(filepath, "w", newline="")
+    vhd_file.write(newline.join(lines) + newline)
+    vhd_file.close()
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or "-h" in sys.argv:
+        print("python generate_vhd.py FILE.VHD N_ROWS [..]")
+        print("-sections N \t -- \t Number of data sections [Default: 3]")
+        print("-crlf \t -- \t Write Windows line endings.")
+        sys.exit()
+    if "-sections" in sys.argv:
+        n_sections = int(sys.argv[sys.argv.index("-sections") + 1])
+    else:
+        n_sections = 3
+    write_VHD_file(sys.argv[1], int(float(sys.argv[2])), n_sections,\
+                   crlf="-crlf" in sys.argv)
@@ -0,0 +1,241 @@
+import numpy as np
+import sys, os, io, json, time, platform, shutil, tempfile, subprocess
+import contextlib
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_PATH)
+
+from vsm import VSMClass
+from vsm_dataextract import VSM_Extract
+from vsm_substract import VSM_Substract
+from generate_vhd import write_VHD_file
+
+BENCHMARK_VERSION = 1
+
+PARAMETER_FILE = "\
+B_column	Applied Field\n\
+M_column	Raw Signal Mx\n\
+B_unit		T\n\
+M_unit		memu\n\
+noise_level	5e-3\n\
+@start data list\n\
+{vhd}	{xye}\n\
+@end data list\n"
+
+@contextlib.contextmanager
+def command_line(args):
+    """Run the script classes with args as command line, output is discarded."""
+    argv = sys.argv
+    sys.argv = args
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+    finally:
+        sys.argv = argv
+
+class VSM_Benchmark(VSMClass):
+    def __init__(self):
+        super().__init__()
+        self.results = {}
+        self.failed_checks = []
+        self.workdir = tempfile.mkdtemp(prefix="vsm_benchmark_")
+        # the scripts write output next to relative input paths
+        cwd = os.getcwd()
+        os.chdir(self.workdir)
+        try:
+            for n_rows in self.sizes:
+                self.results[str(n_rows)] = self.run_size(n_rows)
+        finally:
+            os.chdir(cwd)
+            if not self.keep:
+                shutil.rmtree(self.workdir)
+        self.print_results()
+        self.save_results()
+        if len(self.failed_checks) > 0:
+            sys.exit("Checks failed:\n" + "\n".join(self.failed_checks))
+        if self.compare_path is not None:
+            self.compare_results()
+
+    def help(self):
+        print("python run_benchmarks.py [..]")
+        print("Times the stages of the VSM pipeline on synthetic VHD files and checks "+\
+              "the background error at the sweep turning points.")
+        print("Possible parameters:")
+        print("-sizes N [N2 ...] \t -- \t Number of data rows [Default: 1e3 1e4 1e5 1e6]")
+        print("-repeat N \t -- \t Take best of N runs per stage [Default: 3]")
+        print("-o FILE \t -- \t Save results as JSON [Default: benchmark_results.json]")
+        print("-compare FILE \t -- \t Compare with earlier results, fail on regressions.")
+        print("-threshold F \t -- \t Allowed slowdown factor for -compare [Default: 1.25]")
+        print("-keep \t -- \t Keep the generated files in the temporary folder.")
+
+    def get_args(self):
+        if "-sizes" in sys.argv:
+            self.sizes = []
+            jp = sys.argv.index("-sizes") + 1
+            while jp <= self.n_args and not sys.argv[jp].startswith("-"):
+                self.sizes.append(int(float(sys.argv[jp])))
+                jp += 1
+        else:
+            self.sizes = [1000, 10000, 100000, 1000000]
+        if "-repeat" in sys.argv:
+            self.repeat = int(sys.argv[sys.argv.index("-repeat") + 1])
+        else:
+            self.repeat = 3
+        if "-o" in sys.argv:
+            self.save_path = sys.argv[sys.argv.index("-o") + 1]
+        else:
+            self.save_path = "benchmark_results.json"
+        self.save_path = os.path.abspath(self.save_path)
+        if "-compare" in sys.argv:
+            self.compare_path = os.path.abspath(sys.argv[sys.argv.index("-compare") + 1])
+        else:
+            self.compare_path = None
+        if "-threshold" in sys.argv:
+            self.threshold = float(sys.argv[sys.argv.index("-threshold") + 1])
+        else:
+            self.threshold = 1.25
+        self.keep = "-keep" in sys.argv
+
+    def time_stage(self, stage, args=[]):
+        """Best wall time of repeat calls of stage."""
+        times = []
+        for i in range(self.repeat):
+            with command_line([sys.argv[0]] + args):
+                start = time.perf_counter()
+                stage()
+                times.append(time.perf_counter() - start)
+        return min(times)
+
+    def run_size(self, n_rows):
+        print("Benchmarking", n_rows, "rows")
+        pre = "sample_" + str(n_rows)
+        vhd_path = pre + ".VHD"
+        xye_path = pre + ".xye"
+        bg_path = pre + "_bg.xye"
+        param_path = pre + "_extract.dat"
+        write_VHD_file(vhd_path, n_rows)
+        param_file = open(param_path, "w")
+        param_file.write(PARAMETER_FILE.format(vhd=vhd_path, xye=xye_path))
+        param_file.close()
+
+        timings = {}
+        # complete extraction of one file as run from the command line
+        with command_line([sys.argv[0], "-noindex"]):
+            extract = VSM_Extract(param_path)
+        timings["extract"] = self.time_stage(lambda: VSM_Extract(param_path),\
+                                             ["-noindex"])
+
+        # single stages of the extraction
+        def scan():
+            content, sections = extract.scan_VHD_file(vhd_path)
+            if not isinstance(content, bytes):
+                content.close()
+        timings["scan_VHD"] = self.time_stage(scan)
+
+        def parse():
+            content, sections = extract.scan_VHD_file(vhd_path)
+            B_col, M_col, B_rawunit, M_rawunit = extract.load_columns(\
+                vhd_path, content, sections, extract.pdict["B_column"],\
+                extract.pdict["M_column"])
+            extract.load_data_from_VHD_file(vhd_path, content, sections,\
+                                            B_col, M_col)
+            if not isinstance(content, bytes):
+                content.close()
+        timings["parse_VHD"] = self.time_stage(parse)
+
+        with command_line([sys.argv[0]]):
+            extract.data_string = ""
+            B, M, sM, M_raw, sM_raw, M_rawunit, B_imagecorr, imagecorr_factor =\
+                extract.load_data(vhd_path)
+        columns = [B, M, sM, M_raw, sM_raw]
+        timings["write_xye"] = self.time_stage(lambda: extract.save_xye_file(\
+                                   xye_path, extract.xye_header(M_rawunit), columns))
+
+        # loading .xye files, the background is the sample on shifted fields
+        extract.save_xye_file(bg_path, extract.xye_header(M_rawunit),\
+                              [B + 1e-4, M, sM, M_raw, sM_raw])
+        with command_line([sys.argv[0]]):
+            reader = VSMClass()
+        timings["read_xye"] = self.time_stage(lambda: reader.get_data_from_file(xye_path))
+        reader.use_cache = True
+        with command_line([sys.argv[0]]):
+            reader.get_data_from_file(xye_path)
+        timings["read_xye_cached"] = self.time_stage(\
+                                         lambda: reader.get_data_from_file(xye_path))
+        os.remove(reader.xye_cache_path(xye_path))
+
+        # background substraction
+        with command_line([sys.argv[0], "-batch", bg_path, xye_path]):
+            substract = VSM_Substract()
+        timings["substract"] = self.time_stage(lambda: substract.substract_batch())
+        substract.load_bg()
+        timings["nearest_point_substraction"] = self.time_stage(\
+            lambda: substract.nearest_point_substraction(substract.B, substract.M,\
+                        substract.sM, substract.B_bg, substract.M_bg, substract.sM_bg))
+        self.check_turning_points(substract, n_rows)
+        return timings
+
+    def check_turning_points(self, substract, n_rows):
+        """Error of the substracted background at the first and last point of
+        every sweep branch must stay at the level of the interior points."""
+        sM_bg = substract.nearest_point_substraction(substract.B, substract.M,\
+                    substract.sM, substract.B_bg, substract.M_bg, substract.sM_bg)[2]
+        ends = [idx for kind, loop, branch in substract.branches\
+                for idx in (branch.start, branch.stop - 1) if branch.stop > branch.start]
+        ratio = np.max(sM_bg[ends])/np.median(sM_bg)
+        if ratio > 2.:
+            self.failed_checks.append("nearest_point_substraction (" + str(n_rows) +\
+                " rows): error at turning points %.3g times the median" % ratio)
+
+    def git_commit(self):
+        try:
+            return subprocess.check_output(["git", "rev-parse", "HEAD"],\
+                cwd=REPO_PATH, stderr=subprocess.DEVNULL).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def print_results(self):
+        stages = list(self.results[str(self.sizes[0])].keys())
+        print("\nBest of", self.repeat, "runs in seconds:")
+        print("stage".ljust(28) + "".join([str(n).rjust(12) for n in self.sizes]))
+        for stage in stages:
+            print(stage.ljust(28) + "".join(["%12.4g" % self.results[str(n)][stage]\
+                                             for n in self.sizes]))
+
+    def save_results(self):
+        report = {"version": BENCHMARK_VERSION,
+                  "created": time.strftime("%c"),
+                  "commit": self.git_commit(),
+                  "python": platform.python_version(),
+                  "numpy": np.__version__,
+                  "machine": platform.platform(),
+                  "repeat": self.repeat,
+                  "results": self.results}
+        save_file = open(self.save_path, "w")
+        json.dump(report, save_file, indent=2)
+        save_file.close()
+        print("Saved results to", self.save_path)
+
+    def compare_results(self):
+        compare_file = open(self.compare_path, "r")
+        reference = json.load(compare_file)
+        compare_file.close()
+        print("\nComparison with", self.compare_path,\
+              "(commit " + str(reference.get("commit")) + "):")
+        regressions = []
+        for size, timings in self.results.items():
+            for stage, seconds in timings.items():
+                if stage not in reference["results"].get(size, {}):
+                    continue
+                ratio = seconds/reference["results"][size][stage]
+                print(stage.ljust(28) + size.rjust(12) + "%12.2f" % ratio)
+                if ratio > self.threshold:
+                    regressions.append(stage + " (" + size + " rows): " +\
+                                       "%.2f times slower" % ratio)
+        if len(regressions) > 0:
+            sys.exit("Regressions above threshold " + str(self.threshold) + ":\n" +\
+                     "\n".join(regressions))
+        print("No regressions above threshold", self.threshold)
+
+if __name__ == "__main__":
+    VSM_Benchmark()
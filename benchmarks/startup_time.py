@@ -0,0 +1,125 @@
+import sys, os, time, shutil, tempfile, subprocess
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_PATH)
+
+from vsm import VSMClass
+from vsm_cli import COMMANDS
+from generate_vhd import write_VHD_file
+from run_benchmarks import PARAMETER_FILE
+
+# Start-up check of the vsm_cli.py commands, run it from the repository with
+#
+#   python benchmarks/startup_time.py
+#
+# It exits with a non-zero status and lists the failures if a command is
+# above the time budget or imports a heavy module. Checked are the help of
+# every command and the commands of RUN_COMMANDS on a tiny generated VHD file,
+# which go through the real code path of a data step.
+
+# modules which only commands producing plots or fits may load
+HEAVY_MODULES = ["matplotlib", "scipy", "lmfit"]
+
+# commands run on the generated files: (command, arguments)
+RUN_COMMANDS = [("extract", ["{parameter_file}", "-noindex"])]
+
+class VSM_StartupTime(VSMClass):
+    """Start-up time of the vsm_cli.py commands, fails above a time budget."""
+    def __init__(self):
+        super().__init__()
+        self.workdir = tempfile.mkdtemp(prefix="vsm_startup_")
+        try:
+            self.write_input_files()
+            runs = [(command, ["-h"]) for command in self.commands]
+            runs += [(command, [arg.format(parameter_file=self.parameter_file)\
+                                for arg in args]) for command, args in RUN_COMMANDS]
+            failed = self.check_runs(runs)
+        finally:
+            shutil.rmtree(self.workdir)
+        if len(failed) > 0:
+            sys.exit("Start-up check failed:\n" + "\n".join(failed))
+        print("All commands start within", self.budget, "s")
+
+    def help(self):
+        print("python startup_time.py [..]")
+        print("Times 'vsm_cli.py COMMAND -h' and the extraction of a tiny VHD file, and "+\
+              "checks that no plotting or fitting library is imported.")
+        print("Exits with a non-zero status if a check fails.")
+        print("Possible parameters:")
+        print("-budget S \t -- \t Allowed start-up time in seconds [Default: 0.5]")
+        print("-repeat N \t -- \t Take best of N runs per command [Default: 5]")
+        print("-commands C [C2 ...] \t -- \t Commands to check with -h [Default: all]")
+
+    def get_args(self):
+        if "-budget" in sys.argv:
+            self.budget = float(sys.argv[sys.argv.index("-budget") + 1])
+        else:
+            self.budget = 0.5
+        if "-repeat" in sys.argv:
+            self.repeat = int(sys.argv[sys.argv.index("-repeat") + 1])
+        else:
+            self.repeat = 5
+        if "-commands" in sys.argv:
+            self.commands = []
+            jp = sys.argv.index("-commands") + 1
+            while jp <= self.n_args and not sys.argv[jp].startswith("-"):
+                self.commands.append(sys.argv[jp])
+                jp += 1
+        else:
+            self.commands = list(COMMANDS.keys())
+
+    def write_input_files(self):
+        """Tiny VHD file and its extraction parameter file in the workdir."""
+        write_VHD_file(os.path.join(self.workdir, "tiny.VHD"), 200)
+        self.parameter_file = "tiny_extract.dat"
+        param_file = open(os.path.join(self.workdir, self.parameter_file), "w")
+        param_file.write(PARAMETER_FILE.format(vhd="tiny.VHD", xye="tiny.xye"))
+        param_file.close()
+
+    def check_runs(self, runs):
+        failed = []
+        print("command".ljust(36) + "seconds".rjust(12) + "   heavy imports")
+        for command, args in runs:
+            name = " ".join([command] + args)
+            seconds = self.startup_time(command, args)
+            heavy = self.heavy_imports(command, args)
+            print(name.ljust(36) + "%12.3f" % seconds + "   " + (", ".join(heavy) or "-"))
+            if seconds > self.budget:
+                failed.append(name + ": %.3f s above budget of %.3f s" % (seconds, self.budget))
+            if len(heavy) > 0:
+                failed.append(name + ": imports " + ", ".join(heavy))
+        return failed
+
+    def command_line(self, command, args, python_args=[]):
+        return [sys.executable] + python_args +\
+               [os.path.join(REPO_PATH, "vsm_cli.py"), command] + args
+
+    def run(self, command, args, python_args=[]):
+        """Run the command in the workdir, fails if it does not succeed."""
+        result = subprocess.run(self.command_line(command, args, python_args),\
+                                cwd=self.workdir, stdout=subprocess.DEVNULL,\
+                                stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            sys.exit(" ".join([command] + args) + " failed:\n" + result.stderr.decode())
+        return result
+
+    def startup_time(self, command, args):
+        """Best wall time of repeat runs of the command."""
+        times = []
+        for i in range(self.repeat):
+            start = time.perf_counter()
+            self.run(command, args)
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    def heavy_imports(self, command, args):
+        """Heavy top level packages imported by the command."""
+        result = self.run(command, args, ["-X", "importtime"])
+        imported = set()
+        for line in result.stderr.decode().splitlines():
+            if line.startswith("import time:"):
+                imported.add(line.rsplit("|", 1)[1].strip().split(".")[0])
+        return [module for module in HEAVY_MODULES if module in imported]
+
+if __name__ == "__main__":
+    VSM_StartupTime()
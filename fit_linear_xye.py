@@ -1,8 +1,8 @@
 import sys, os.path
-import matplotlib.pyplot as plt
 import numpy as np
-import common_math
-import lmfit
+from vsm import weighted_linear_fit, StageProfiler, get_profiler, show_plots, pyplot
+
+profiler = StageProfiler()
 
 #  Read input files:
 def load_xyfile(filepath):
@@ -71,13 +71,7 @@ def load_xyefile(filepath):
 
 
 def get_slice(array, left, right):
-    return -((array < left) -  (right < array))
-
-def residuum(p, x, y, sy):
-    return (common_math.linear(x, p["m"].value, p["b"].value) - y)/sy
-
-def residuum_no_err(p, x, y):
-    return (common_math.linear(x, p["m"].value, p["b"].value) - y)
+    return ~((array < left) | (right < array))
 
 def plotfit_xye(pfile_path):
     
@@ -86,10 +80,11 @@ def plotfit_xye(pfile_path):
     else:
         load_xy = False
     
-    if load_xy:
-        x, y = load_xyfile(pfile_path)
-    else:
-        x, y, sy = load_xyefile(pfile_path)
+    with profiler.stage("load"):
+        if load_xy:
+            x, y = load_xyfile(pfile_path)
+        else:
+            x, y, sy = load_xyefile(pfile_path)
         
     #Initialize variables
     xvar = "\mathit{x}"
@@ -141,6 +136,8 @@ def plotfit_xye(pfile_path):
         plot_path = sys.argv[sys.argv.index("-save") + 1]
         
             
+    profiler.start_stage("plot")
+    plt = pyplot()
     fig, ax = plt.subplots() #Initialize plot canvas
     # Restricted fit area defined?
     if "-fit_lim" in sys.argv:
@@ -152,12 +149,12 @@ def plotfit_xye(pfile_path):
         x_plot = x[fit_slice]
         y_plot = y[fit_slice]
         #Excluded data
-        x_exc = x[-fit_slice]
-        y_exc = y[-fit_slice]
+        x_exc = x[~fit_slice]
+        y_exc = y[~fit_slice]
 
         if not load_xy:
             sy_plot = sy[fit_slice]
-            sy_exc = sy[-fit_slice]
+            sy_exc = sy[~fit_slice]
         
     
         if len(x_exc) > 0:
@@ -171,40 +168,32 @@ def plotfit_xye(pfile_path):
         if not load_xy:
             sy_plot = sy
 
-    # Initialize fit variables
-    p = lmfit.Parameters()
-    minit = sys.argv[sys.argv.index("-m")+1] if "-m" in sys.argv else 1
-    binit = sys.argv[sys.argv.index("-b")+1] if "-b" in sys.argv else 0
-    
+    # Fit straight line in closed form
     if "-fixb" in sys.argv:
-        varyb = False
+        fixed_b = float(sys.argv[sys.argv.index("-b")+1]) if "-b" in sys.argv else 0.
     else:
-        varyb = True
-        
-    p.add("m", minit)
-    p.add("b", binit, vary=varyb)
-    
-    if load_xy:
-        fit_result = lmfit.minimize(residuum_no_err, p, args=(x, y))
-    else:
-        fit_result = lmfit.minimize(residuum, p, args=(x, y, sy))
-    print(lmfit.fit_report(fit_result))
-    
-    m = fit_result.params["m"].value
-    sm = fit_result.params["m"].stderr
-    b = fit_result.params["b"].value
-    sb = fit_result.params["b"].stderr
+        fixed_b = None
+    
+    with profiler.stage("fit"):
+        if load_xy:
+            m, b, sm, sb, chi2 = weighted_linear_fit(x_plot, y_plot, intercept=fixed_b)
+        else:
+            m, b, sm, sb, chi2 = weighted_linear_fit(x_plot, y_plot, sy_plot, intercept=fixed_b)
+    print("Fit result:")
+    print("\tdata points  = " + str(len(x_plot)))
+    print("\treduced chi2 = " + str(chi2))
+    print("\tm = " + str(m) + " +/- " + str(sm))
+    print("\tb = " + str(b) + " +/- " + str(sb) + (" (fixed)" if fixed_b is not None else ""))
     
     prec = "{:.3e}"
     fitresultstr = r"$\mathit{m} \, = \, $" + prec.format(m) + " +/- " + prec.format(sm) + "\n"+\
             "$\mathit{b} \, = \, $" + prec.format(b) + " +/-" + prec.format(sb)
     
-    chi2 = fit_result.redchi
     if load_xy:
         ax.plot(x_plot, y_plot, linestyle='None', color='#2b8cbe', label=labelname)
     else:
         ax.errorbar(x_plot, y_plot, sy_plot, linestyle='None', color='#2b8cbe', label=labelname)
-    ax.plot(x, common_math.linear(x, m, b), color='#e34a33', marker='None', label=fitresultstr)
+    ax.plot(x, m*x + b, color='#e34a33', marker='None', label=fitresultstr)
     
     if chi2 < 1e-3:
         chi2str = "{:.3e}".format(chi2)
@@ -218,11 +207,18 @@ def plotfit_xye(pfile_path):
     ax.set_ylim([plotminy, plotmaxy])
     plt.legend(loc='best', fontsize=10)
     
+    if plot_path == "" and not show_plots():
+        plot_path = os.path.splitext(pfile_path)[0] + ".png"
+    
     if plot_path != "":
         fig.savefig(plot_path)
         print("Saved plot to", plot_path)
+    profiler.end_stage()
 
-    plt.show()
+    if show_plots():
+        plt.show()
+    else:
+        plt.close(fig)
 
 
 if __name__ == "__main__":
@@ -237,15 +233,19 @@ if __name__ == "__main__":
         print("-vars XVAR YVAR \t -- \t What is the variable of x and y-axis?")
         print("-units XUNIT YUNIT \t -- \t What are the units of the x and y axis?")
         print("-save FILENAME \t -- \t Save image to file.")
-        print("-m MINIT \t -- \t Initial slope for fit [Default: 1]")
-        print("-b BINIT \t -- \t Initial interception for ift [Default: 0]")
+        print("-noshow \t -- \t Only save the image (to xyefile.png without -save), no window.")
+        print("-b B \t -- \t Interception used with -fixb [Default: 0]")
         print("-xy \t -- \t Work without errors on y")
         print("-u x y [sy]\t -- \t Use columns for loading.")
         print("-fixb \t -- \t Dont vary the interception value")
         print("")
         print("-vsm \t -- \t VSM mode")
+        print("-profile \t -- \t Print wall time of each stage.")
+        print("-profile_memory \t -- \t Also trace peak memory, slows down the stages.")
+        print("-profile_report FILE \t -- \t Also save the profile as JSON.")
         sys.exit()
         
     # Initialization:
     pfile_path = sys.argv[1]
+    profiler = get_profiler()
     plotfit_xye(pfile_path)
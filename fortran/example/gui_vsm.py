@@ -3,13 +3,15 @@ from SliderApp.slider_fit_app import SliderFitApp, cPlotAndFit
 
 import numpy as np
 import sys, lmfit
-from VSM.VSMFortran import models  as vsmmodel
+from VSM.vsm_models import MagnetizationCache
 
 class GuiApp(cPlotAndFit):
     def init_data(self):
         self.x = np.linspace(-1, 1, 1000)
 
         self.T = 300
+        # Ms and chi sliders only rescale a cached curve
+        self.model_cache = MagnetizationCache()
         
         self.p = lmfit.Parameters()
         self.p.add("Ms", 200, min=0, max=500)
@@ -19,8 +21,8 @@ class GuiApp(cPlotAndFit):
         self.ymodel = self.get_model(self.p, self.x)
 
     def get_model(self, p, B):
-        return vsmmodel.magnetization_mu(B,\
-            p["Ms"], p["mu"], self.T, p["sig_mu"]) + p["chi"]*B
+        return self.model_cache.magnetization(B,\
+            p["Ms"], p["mu"], self.T, p["sig_mu"], p["chi"])
         
 if __name__ == "__main__":
     app = QApplication(sys.argv)
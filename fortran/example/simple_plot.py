@@ -4,7 +4,7 @@
 
 import matplotlib.pyplot as plt
 import numpy as np
-from VSM.VSMFortran import models  as vsmmodel
+from VSM.vsm_models import models  as vsmmodel
 
 Ms = 1
 mu = 20e3
@@ -5,6 +5,8 @@ implicit none
     double precision, parameter :: two_sq3 = 2d0*sqrt(3d0)
     
     integer :: n_integration_cuts = 50
+    ! probability mass cut off on each side of lognormal distributions
+    double precision :: lognormal_tail = 5d-7
 contains
     ! Help-Functions
     subroutine read_arg(i_arg, parameter_value)
@@ -314,6 +316,51 @@ contains
             end function integrate02
     end subroutine twodim_integral_variable_bounds
     
+    subroutine gauss_hermite(n, x, w)
+        ! Nodes x and weights w for integrals of exp(-x**2)*f(x) over the
+        ! real axis, Newton iteration on the normalized Hermite recurrence
+        integer, intent(in) :: n
+        double precision, dimension(n), intent(out) :: x, w
+
+        double precision, parameter :: pim4 = 0.7511255444649425d0 ! pi**(-1/4)
+        double precision, parameter :: eps = 3d-14
+        integer, parameter :: maxit = 100
+        double precision :: p1, p2, p3, pp, z, z1
+        integer :: i, its, j, m
+
+        m = (n + 1)/2
+        do i=1, m
+            if (i == 1) then
+                z = sqrt(dble(2*n+1)) - 1.85575d0*dble(2*n+1)**(-0.16667d0)
+            else if (i == 2) then
+                z = z - 1.14d0*dble(n)**0.426d0/z
+            else if (i == 3) then
+                z = 1.86d0*z - 0.86d0*x(1)
+            else if (i == 4) then
+                z = 1.91d0*z - 0.91d0*x(2)
+            else
+                z = 2d0*z - x(i-2)
+            end if
+            do its=1, maxit
+                p1 = pim4
+                p2 = 0d0
+                do j=1, n
+                    p3 = p2
+                    p2 = p1
+                    p1 = z*sqrt(2d0/j)*p2 - sqrt(dble(j-1)/j)*p3
+                end do
+                pp = sqrt(2d0*n)*p2
+                z1 = z
+                z = z1 - p1/pp
+                if (abs(z-z1) <= eps) exit
+            end do
+            x(i) = z
+            x(n+1-i) = -z
+            w(i) = 2d0/(pp*pp)
+            w(n+1-i) = w(i)
+        end do
+    end subroutine gauss_hermite
+
     subroutine get_cutoff_gaussian(mu, sig, left_cutoff, right_cutoff)
         double precision, intent(in) :: mu, sig
         double precision, intent(out) :: left_cutoff, right_cutoff
@@ -327,38 +374,79 @@ contains
         end if
     end subroutine get_cutoff_gaussian
 
+    double precision function normal_quantile(p)
+        ! Quantile of the standard normal distribution, algorithm AS 241
+        ! (PPND16) by M. J. Wichura, relative accuracy about 1d-16
+        double precision, intent(in) :: p
+
+        double precision :: q, r
+
+        q = p - 0.5d0
+        if (abs(q) <= 0.425d0) then
+            r = 0.180625d0 - q*q
+            normal_quantile = q * (((((((2509.0809287301226727d0*r + &
+                33430.575583588128105d0)*r + 67265.770927008700853d0)*r + &
+                45921.953931549871457d0)*r + 13731.693765509461125d0)*r + &
+                1971.5909503065514427d0)*r + 133.14166789178437745d0)*r + &
+                3.387132872796366608d0) / &
+                (((((((5226.495278852545925d0*r + &
+                28729.085735721942674d0)*r + 39307.89580009271061d0)*r + &
+                21213.794301586595867d0)*r + 5394.1960214247511077d0)*r + &
+                687.1870074920579083d0)*r + 42.313330701600911252d0)*r + 1d0)
+            return
+        end if
+
+        if (q < 0d0) then
+            r = p
+        else
+            r = 1d0 - p
+        end if
+        r = sqrt(-log(r))
+        if (r <= 5d0) then
+            r = r - 1.6d0
+            normal_quantile = (((((((7.7454501427834140764d-4*r + &
+                0.0227238449892691845833d0)*r + 0.24178072517745061177d0)*r + &
+                1.27045825245236838258d0)*r + 3.64784832476320460504d0)*r + &
+                5.7694972214606914055d0)*r + 4.6303378461565452959d0)*r + &
+                1.42343711074968357734d0) / &
+                (((((((1.05075007164441684324d-9*r + &
+                5.475938084995344946d-4)*r + 0.0151986665636164571966d0)*r + &
+                0.14810397642748007459d0)*r + 0.68976733498510000455d0)*r + &
+                1.6763848301838038494d0)*r + 2.05319162663775882187d0)*r + 1d0)
+        else
+            r = r - 5d0
+            normal_quantile = (((((((2.01033439929228813265d-7*r + &
+                2.71155556874348757815d-5)*r + 0.0012426609473880784386d0)*r + &
+                0.026532189526576123093d0)*r + 0.29656057182850489123d0)*r + &
+                1.7848265399172913358d0)*r + 5.4637849111641143699d0)*r + &
+                6.6579046435011037772d0) / &
+                (((((((2.04426310338993978564d-15*r + &
+                1.4215117583164458887d-7)*r + 1.8463183175100546818d-5)*r + &
+                7.868691311456132591d-4)*r + 0.0148753612908506148525d0)*r + &
+                0.13692988092273580531d0)*r + 0.59983220655588793769d0)*r + 1d0)
+        end if
+        if (q < 0d0) normal_quantile = -normal_quantile
+    end function normal_quantile
+
     subroutine get_cutoff_lognormal(mu, sig, left_cutoff, right_cutoff)
+        ! Cut off the lognormal distribution where the probability mass
+        ! outside of [left_cutoff, right_cutoff] is lognormal_tail on each
+        ! side, using the inverse cumulative distribution function.
+        ! Called once per magnetization curve outside of parallel regions,
+        ! the quantile is cheap enough to be computed on every call.
         double precision, intent(in) :: mu, sig
         double precision, intent(out) :: left_cutoff, right_cutoff
-        
-        double precision :: prob_integrated
-        
-        double precision :: abserr
-        integer :: neval, ier, last
-        integer, dimension(50) :: iwork
-        double precision, dimension(200) :: work
+
+        double precision :: z
         
         if (sig > 0d0) then
-            left_cutoff = mu*exp(-5*sig)
-            right_cutoff = mu*exp(-sig**2) + sig*mu
-            prob_integrated = 0d0
-            ! Shift right cutoff of integral, until lognormal distribution
-            ! integrates to 1 with 1d-6 tolerance.
-            do while (abs(prob_integrated-1d0) > 1d-6)
-                call dqag(lognormal_function, left_cutoff, right_cutoff, &
-                          0d0, 1d-10, 6, prob_integrated, abserr, neval, &
-                          ier, n_integration_cuts, 4*n_integration_cuts, last, iwork, work)
-                right_cutoff = right_cutoff + sig*mu
-            end do
+            z = normal_quantile(lognormal_tail)
+            left_cutoff = mu*exp(sig*z)
+            right_cutoff = mu*exp(-sig*z)
         else
             left_cutoff = 0d0
             right_cutoff = 0d0
         end if
-        contains
-            double precision function lognormal_function(x)
-                double precision :: x
-                call lognormal(x, mu, sig, lognormal_function)
-            end function lognormal_function
     end subroutine get_cutoff_lognormal
     
     subroutine mean(x, Nx, meanx)
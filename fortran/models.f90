@@ -1,30 +1,80 @@
 module models
 use math
+!$ use omp_lib
 implicit none
 
 double precision, parameter :: kB = 1.38064852d-23 ! J/K
 double precision, parameter :: muB = 9.274009994d-24 ! J/T
 double precision, parameter :: muB_by_kB = 0.6717140430498562 ! K/T
 
+! threads used by the parallel loops, 0 = OpenMP default
+integer :: n_threads = 0
+! loops with fewer iterations run serially
+integer :: serial_threshold = 16
+
 contains
+    subroutine set_num_threads(threads)
+        integer, intent(in) :: threads
+        n_threads = max(threads, 0)
+    end subroutine set_num_threads
+
+    subroutine set_serial_threshold(threshold)
+        integer, intent(in) :: threshold
+        serial_threshold = max(threshold, 0)
+    end subroutine set_serial_threshold
+
+    subroutine get_parallel_settings(threads, max_threads, threshold)
+        ! threads: setting of set_num_threads, max_threads: threads actually
+        ! used by a parallel loop (1 without OpenMP)
+        integer, intent(out) :: threads, max_threads, threshold
+        threads = n_threads
+        max_threads = active_threads()
+        threshold = serial_threshold
+    end subroutine get_parallel_settings
+
+    integer function active_threads()
+        active_threads = 1
+        !$ active_threads = omp_get_max_threads()
+        if (n_threads > 0) active_threads = n_threads
+    end function active_threads
+
     double precision function langevin(B, p, Np)
         !Langevin: Spherical Homogenously Magnetized Particle with large moment
         double precision, intent(in) :: B
         double precision, dimension(Np), intent(in) :: p
         integer, intent(in) :: Np
 
-        double precision :: Ms, xi, x
+        double precision :: Ms, xi, x, x2
         Ms = p(1)
         xi = p(2)
 
-        if (abs(B) > 1e-9) then
-            x = xi*B
-            langevin = Ms * (1d0/tanh(x) - 1d0/x)
+        x = xi*B
+        if (abs(x) < 0.1d0) then
+            ! series expansion, avoids cancellation of 1/tanh(x) - 1/x
+            x2 = x*x
+            langevin = Ms * x*(1d0/3d0 + x2*(-1d0/45d0 + x2*(2d0/945d0 + &
+                       x2*(-1d0/4725d0 + x2*2d0/93555d0))))
         else
-            langevin = 0d0
+            langevin = Ms * (1d0/tanh(x) - 1d0/x)
         end if
     end function langevin
 
+    double precision function langevin_derivative(x)
+        ! dL/dx of the Langevin function L(x) = 1/tanh(x) - 1/x
+        double precision, intent(in) :: x
+        double precision :: x2
+
+        if (abs(x) < 0.1d0) then
+            x2 = x*x
+            langevin_derivative = 1d0/3d0 + x2*(-1d0/15d0 + x2*(2d0/189d0 + &
+                                  x2*(-1d0/675d0 + x2*2d0/10395d0)))
+        else if (abs(x) > 350d0) then
+            langevin_derivative = 1d0/(x*x)
+        else
+            langevin_derivative = 1d0/(x*x) - 1d0/sinh(x)**2
+        end if
+    end function langevin_derivative
+
     double precision function langevin_mu(B, p, Np)
         double precision, intent(in) :: B
         double precision, dimension(Np), intent(in) :: p
@@ -54,7 +104,7 @@ contains
         call get_cutoff_lognormal(mu, sig_mu, mu_min, mu_max) 
         
         p = (/Ms, mu, T/)
-        !$omp parallel
+        !$omp parallel if(NB >= serial_threshold) num_threads(active_threads())
         !$omp do
         do iB=1, NB
             call integrate_size_distribution(B(iB), p, Np, &
@@ -65,5 +115,161 @@ contains
         !$omp end do
         !$omp end parallel
     end subroutine magnetization_mu
+
+    subroutine magnetization_mu_nodes(B, Ms, mu, T, sig_mu, Nnodes, n_check, &
+                                      NB, Magnetization, error_estimate)
+        ! Same as magnetization_mu, but the lognormal distribution of mu is
+        ! integrated with Nnodes fixed Gauss-Hermite nodes in log(mu). The
+        ! Langevin function is evaluated for all B x nodes at once and
+        ! reduced by a matrix-vector product with the weights.
+        ! error_estimate is the largest deviation from the adaptive
+        ! integration at n_check fields spread over B, -1 if n_check = 0.
+        double precision, dimension(NB), intent(in) :: B
+        double precision, intent(in) :: Ms, mu, T, sig_mu
+        integer, intent(in) :: Nnodes, n_check
+        integer, intent(in) :: NB
+        double precision, dimension(NB), intent(out) :: Magnetization
+        double precision, intent(out) :: error_estimate
+        !f2py integer, optional, intent(in) :: Nnodes = 32
+        !f2py integer, optional, intent(in) :: n_check = 0
+
+        integer, parameter :: Np = 3
+        double precision, dimension(Np) :: p
+        double precision, dimension(Nnodes) :: nodes, weights, xi
+        double precision, dimension(NB, Nnodes) :: kernel
+        double precision :: mu_min, mu_max, M_adaptive
+        integer :: iB, inode, icheck
+
+        p = (/Ms, mu, T/)
+        if (sig_mu > 0d0) then
+            call gauss_hermite(Nnodes, nodes, weights)
+            ! mu = mu*exp(sig_mu*z) with z standard normal distributed
+            xi = mu*exp(sig_mu*sqrt(2d0)*nodes)/T*muB_by_kB
+            weights = weights/sqrt(pi)
+
+            !$omp parallel do private(inode) &
+            !$omp if(NB >= serial_threshold) num_threads(active_threads())
+            do iB=1, NB
+                do inode=1, Nnodes
+                    kernel(iB, inode) = langevin(B(iB), (/1d0, xi(inode)/), 2)
+                end do
+            end do
+            !$omp end parallel do
+            Magnetization = Ms*matmul(kernel, weights)
+        else
+            do iB=1, NB
+                Magnetization(iB) = langevin_mu(B(iB), p, Np)
+            end do
+        end if
+
+        error_estimate = -1d0
+        if (n_check > 0 .and. NB > 0) then
+            call get_cutoff_lognormal(mu, sig_mu, mu_min, mu_max)
+            error_estimate = 0d0
+            do icheck=1, min(n_check, NB)
+                iB = 1 + ((icheck - 1)*(NB - 1))/max(min(n_check, NB) - 1, 1)
+                call integrate_size_distribution(B(iB), p, Np, &
+                            2, mu_min, mu_max, sig_mu, &
+                            langevin_mu, lognormal, M_adaptive)
+                error_estimate = max(error_estimate, &
+                                     abs(Magnetization(iB) - M_adaptive))
+            end do
+        end if
+    end subroutine magnetization_mu_nodes
+
+    subroutine magnetization_mu_jacobian(B, Ms, mu, T, sig_mu, Nnodes, NB, &
+                                         Magnetization, Jacobian)
+        ! magnetization_mu_nodes together with the derivatives of M with
+        ! respect to Ms, mu and sig_mu (columns of Jacobian), evaluated on the
+        ! same Gauss-Hermite nodes.
+        double precision, dimension(NB), intent(in) :: B
+        double precision, intent(in) :: Ms, mu, T, sig_mu
+        integer, intent(in) :: Nnodes
+        integer, intent(in) :: NB
+        double precision, dimension(NB), intent(out) :: Magnetization
+        double precision, dimension(NB, 3), intent(out) :: Jacobian
+        !f2py integer, optional, intent(in) :: Nnodes = 32
+
+        double precision, dimension(Nnodes) :: nodes, weights, xi
+        double precision, dimension(NB, Nnodes) :: kernel, dkernel
+        double precision :: x, dL
+        integer :: iB, inode
+
+        if (sig_mu > 0d0) then
+            call gauss_hermite(Nnodes, nodes, weights)
+            nodes = sqrt(2d0)*nodes
+            xi = mu*exp(sig_mu*nodes)/T*muB_by_kB
+            weights = weights/sqrt(pi)
+
+            ! kernel = L(x), dkernel = x*dL/dx with x = xi*B
+            !$omp parallel do private(inode, x) &
+            !$omp if(NB >= serial_threshold) num_threads(active_threads())
+            do iB=1, NB
+                do inode=1, Nnodes
+                    x = xi(inode)*B(iB)
+                    kernel(iB, inode) = langevin(B(iB), (/1d0, xi(inode)/), 2)
+                    dkernel(iB, inode) = x*langevin_derivative(x)
+                end do
+            end do
+            !$omp end parallel do
+            Jacobian(:, 1) = matmul(kernel, weights)
+            Jacobian(:, 2) = Ms/mu*matmul(dkernel, weights)
+            Jacobian(:, 3) = Ms*matmul(dkernel, weights*nodes)
+        else
+            ! dM/dsig_mu vanishes at sig_mu = 0
+            do iB=1, NB
+                x = mu/T*muB_by_kB*B(iB)
+                dL = langevin_derivative(x)
+                Jacobian(iB, 1) = langevin_mu(B(iB), (/1d0, mu, T/), 3)
+                Jacobian(iB, 2) = Ms/mu*x*dL
+                Jacobian(iB, 3) = 0d0
+            end do
+        end if
+        Magnetization = Ms*Jacobian(:, 1)
+    end subroutine magnetization_mu_jacobian
+
+    subroutine magnetization_mu_grid(B, params, Nnodes, NB, Ngrid, &
+                                     Magnetization)
+        ! magnetization_mu_nodes for Ngrid parameter sets at once. Each row
+        ! of params is (Ms, mu, T, sig_mu), row i of Magnetization is M(B)
+        ! for params(i, :). The loop runs in parallel over grid x field.
+        double precision, dimension(NB), intent(in) :: B
+        double precision, dimension(Ngrid, 4), intent(in) :: params
+        integer, intent(in) :: Nnodes
+        integer, intent(in) :: NB, Ngrid
+        double precision, dimension(Ngrid, NB), intent(out) :: Magnetization
+        !f2py integer, optional, intent(in) :: Nnodes = 32
+
+        double precision, dimension(Nnodes) :: nodes, weights
+        double precision, dimension(Nnodes, Ngrid) :: xi
+        double precision :: M
+        integer :: igrid, iB, inode
+
+        call gauss_hermite(Nnodes, nodes, weights)
+        weights = weights/sqrt(pi)
+        do igrid=1, Ngrid
+            xi(:, igrid) = params(igrid, 2)*exp(params(igrid, 4)*sqrt(2d0)*nodes)&
+                           /params(igrid, 3)*muB_by_kB
+        end do
+
+        !$omp parallel do collapse(2) private(inode, M) &
+        !$omp if(NB*Ngrid >= serial_threshold) num_threads(active_threads())
+        do iB=1, NB
+            do igrid=1, Ngrid
+                if (params(igrid, 4) > 0d0) then
+                    M = 0d0
+                    do inode=1, Nnodes
+                        M = M + weights(inode)*langevin(B(iB), &
+                                (/1d0, xi(inode, igrid)/), 2)
+                    end do
+                else
+                    M = langevin_mu(B(iB), (/1d0, params(igrid, 2), &
+                                    params(igrid, 3)/), 3)
+                end if
+                Magnetization(igrid, iB) = params(igrid, 1)*M
+            end do
+        end do
+        !$omp end parallel do
+    end subroutine magnetization_mu_grid
 end module models
 
@@ -1,6 +1,6 @@
 import sys
-import matplotlib.pyplot as plt
 import numpy as np
+from vsm import find_sweep_branches, sweep_tolerance, get_profiler, show_plots, pyplot
 
 #  Read input files:
 
@@ -131,20 +131,65 @@ def load_xyfile(filepath):
     return np.asarray(x), np.asarray(y)
 
 def get_slice(array, left, right):
-    return -((array < left) -  (right < array))
+    return ~((array < left) | (right < array))
+
+def minmax_decimation(x, y, sy=None, n_bins=1000, n_ybins=None):
+    """Indices of the points needed to draw a sweep at n_bins pixels width.
+
+    Every branch of monotone x (see find_sweep_branches) is divided into
+    n_bins bins over the x range of all points. In each bin the points with
+    the lowest and the highest y are kept, with sy the points with the lowest
+    lower and highest upper end of the error bar. First and last point of
+    every branch are kept as well. With n_ybins, also one point of every
+    occupied (x, y) bin is kept, so that noise bands drawn with markers
+    stay filled. Returns the sorted indices.
+    """
+    N = len(x)
+    xmin = np.min(x) if N > 0 else 0.
+    xmax = np.max(x) if N > 0 else 0.
+    if N <= 4*n_bins or xmax == xmin:
+        return np.arange(N)
+    if sy is None:
+        low, high = y, y
+    else:
+        low, high = y - sy, y + sy
+    bins = np.minimum(((x - xmin)/(xmax - xmin)*n_bins).astype(int), n_bins - 1)
+    if n_ybins is not None and np.max(y) > np.min(y):
+        ybins = np.minimum(((y - np.min(y))/(np.max(y) - np.min(y))*n_ybins).astype(int),\
+                           n_ybins - 1)
+        cells = bins*n_ybins + ybins
+    else:
+        cells = None
+
+    # reversals of x within one bin are not visible and do not split a branch
+    keep = []
+    for kind, loop, branch in find_sweep_branches(x, (xmax - xmin)/n_bins):
+        idx = np.arange(branch.start, branch.stop)
+        branch_bins = bins[branch]
+        # sorted by bin and value, the first point of a bin is its minimum
+        order = np.lexsort((low[branch], branch_bins))
+        first = np.flatnonzero(np.diff(branch_bins[order], prepend=-1) != 0)
+        keep.append(idx[order[first]])
+        order = np.lexsort((high[branch], branch_bins))
+        last = np.flatnonzero(np.diff(branch_bins[order], append=n_bins) != 0)
+        keep.append(idx[order[last]])
+        keep.append(idx[[0, -1]])
+        if cells is not None:
+            keep.append(idx[np.unique(cells[branch], return_index=True)[1]])
+    return np.unique(np.concatenate(keep))
 
 def plot_xye(x, y, sy, ymodel, plot_slice, ax, linecolor=None, linestyle="None",\
                 marker='.', labelname=None, modelname = None, modelcolor='red'):
     x_plot = x[plot_slice]
     y_plot = y[plot_slice]
-    x_exc = x[-plot_slice]
-    y_exc = y[-plot_slice]
+    x_exc = x[~plot_slice]
+    y_exc = y[~plot_slice]
     if sy is not None:
         sy_plot = sy[plot_slice]
-        sy_exc = sy[-plot_slice]
+        sy_exc = sy[~plot_slice]
     if ymodel is not None:
         ymodel_plot = ymodel[plot_slice]
-        ymodel_exc = ymodel[-plot_slice]
+        ymodel_exc = ymodel[~plot_slice]
         
     if "-linestyle" in sys.argv:
         linestyle = sys.argv[sys.argv.index("-linestyle")+1]
@@ -160,12 +205,30 @@ def plot_xye(x, y, sy, ymodel, plot_slice, ax, linecolor=None, linestyle="None",
         linecolor = sys.argv[sys.argv.index("-lc")+1]
     
     if "-nv" in sys.argv:
-        #Assuming all symmetric measurements find virgin curve and remove it
-        virgin = round(len(x_plot)/5 , 0) 
-        virgin = int(virgin)
-        x_plot = x_plot[virgin:]
-        y_plot = y_plot[virgin:]
-        sy_plot = sy_plot[virgin:]
+        #Find virgin curve from the sweep direction and remove it
+        kind, loop, first_branch = find_sweep_branches(x_plot, sweep_tolerance(x_plot))[0]
+        if kind == "virgin":
+            virgin = first_branch.stop
+            x_plot = x_plot[virgin:]
+            y_plot = y_plot[virgin:]
+            if sy is not None:
+                sy_plot = sy_plot[virgin:]
+            if ymodel is not None:
+                ymodel_plot = ymodel_plot[virgin:]
+
+    if not "-nodecimate" in sys.argv:
+        # about one bin per pixel of the figure width, limits are set from the full data
+        n_bins = int(ax.figure.get_figwidth()*ax.figure.dpi)
+        n_ybins = int(ax.figure.get_figheight()*ax.figure.dpi)
+        keep = minmax_decimation(x_plot, y_plot, sy_plot if sy is not None else None,\
+                                 n_bins, n_ybins)
+        keep_exc = minmax_decimation(x_exc, y_exc, sy_exc if sy is not None else None,\
+                                     n_bins, n_ybins)
+        x_plot, y_plot, x_exc, y_exc = x_plot[keep], y_plot[keep], x_exc[keep_exc], y_exc[keep_exc]
+        if sy is not None:
+            sy_plot, sy_exc = sy_plot[keep], sy_exc[keep_exc]
+        if ymodel is not None:
+            ymodel_plot = ymodel_plot[keep]
 
     if len(x_exc) > 0:
         if sy is None:
@@ -185,14 +248,14 @@ def plot_xye(x, y, sy, ymodel, plot_slice, ax, linecolor=None, linestyle="None",
                 color=modelcolor, label=modelname)
     
     if labelname is not None or modelname is not None:
-        plt.legend(loc='upper left', fontsize=10)
+        ax.legend(loc='upper left', fontsize=10)
 
     
 
 
 if __name__ == "__main__":
     num_args = len(sys.argv) - 1
-    if num_args < 1 or "-help" in sys.argv:
+    if num_args < 1 or "-help" in sys.argv or "-h" in sys.argv:
         print("ERROR: Usage of plot_xy.py:")
         print("python fit_vsm.py params [..]")
         print("Possible parameters:")
@@ -211,12 +274,19 @@ if __name__ == "__main__":
         print("-u \t -- \t Set columns which should be read from file.")
         print("-model \t -- \t Plot model.")
         print("-save savename \t -- \t Save to savename")
+        print("-noshow \t -- \t Only save the plot (to params.png without -save), no window")
         print("-vsm \t -- Plot VSM Data")
         print("-nv \t -- No Virgin curve")
+        print("-nodecimate \t -- Plot every point, not only the min/max points per pixel")
+        print("-profile \t -- Print wall time of each stage")
+        print("-profile_memory \t -- Also trace peak memory, slows down the stages")
+        print("-profile_report FILE \t -- Also save the profile as JSON")
         sys.exit()
         
     # Initialization:
     pfile_path = sys.argv[1]
+    profiler = get_profiler()
+    plt = pyplot()
     fig, ax = plt.subplots()
     
     xvar = "\mathit{x}"
@@ -236,6 +306,7 @@ if __name__ == "__main__":
         nolabel_mode=True
         plot_path = pfile_path.rsplit(".", 1)[0] + ".png"
         
+    profiler.start_stage("load")
     if xymode:
         if modelmode:
             x, y, ymodel = load_xymfile(pfile_path)
@@ -249,6 +320,7 @@ if __name__ == "__main__":
         else:
             x, y, sy = load_xyefile(pfile_path)
             ymodel = None
+    profiler.end_stage()
         
     if "-plot_lim" in sys.argv:
         minx = float(sys.argv[sys.argv.index("-plot_lim") + 1])
@@ -265,6 +337,7 @@ if __name__ == "__main__":
     if labelname is None:
         labelname=pfile_path.rsplit(".",1)[0]
         
+    profiler.start_stage("plot")
     plot_xye(x, y, sy, ymodel, plot_slice, ax, labelname=labelname)
     if "-plot_lim" in sys.argv:
         minx = float(sys.argv[sys.argv.index("-plot_lim")+1])
@@ -321,7 +394,14 @@ if __name__ == "__main__":
     if "-save" in sys.argv:
         plot_path = sys.argv[sys.argv.index("-save")+1]
     
+    if plot_path is None and not show_plots():
+        plot_path = pfile_path.rsplit(".", 1)[0] + ".png"
+    
     if plot_path is not None:
         fig.savefig(plot_path)
         print("Saved plot to", plot_path)
-    plt.show()
+    profiler.end_stage()
+    if show_plots():
+        plt.show()
+    else:
+        plt.close(fig)
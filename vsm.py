@@ -1,34 +1,332 @@
-import sys
+import sys, os, json, time, atexit, contextlib, tracemalloc
 import numpy as np
 
-class VSMClass():
-    def __init__(self):
+XYE_CACHE_VERSION = 1
+
+def weighted_linear_fit(x, y, sy=None, intercept=None):
+    """Weighted least squares fit of y = m*x + b.
+
+    Solved in closed form, the sums run over the last axis so that several
+    data sets of equal length can be fitted at once. If intercept is given,
+    b is fixed to this value and only m is fitted. Like lmfit, the standard
+    errors are scaled by the reduced chi-square.
+    Returns m, b, sm, sb, reduced chi-square.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if sy is None:
+        w = np.ones(x.shape)
+    else:
+        w = 1./np.asarray(sy, dtype=float)**2
+    N = x.shape[-1]
+
+    if intercept is None:
+        S = np.sum(w, axis=-1)
+        x_mean = np.sum(w*x, axis=-1)/S
+        y_mean = np.sum(w*y, axis=-1)/S
+        dx = x - np.expand_dims(x_mean, -1)
+        Sxx = np.sum(w*dx**2, axis=-1)
+        m = np.sum(w*dx*y, axis=-1)/Sxx
+        b = y_mean - m*x_mean
+        var_m = 1./Sxx
+        var_b = 1./S + x_mean**2*var_m
+        nvarys = 2
+    else:
+        Sxx = np.sum(w*x**2, axis=-1)
+        m = np.sum(w*x*(y - intercept), axis=-1)/Sxx
+        b = intercept + 0.*m
+        var_m = 1./Sxx
+        var_b = 0.*m
+        nvarys = 1
+
+    residuals = y - np.expand_dims(m, -1)*x - np.expand_dims(b, -1)
+    chi2 = np.sum(w*residuals**2, axis=-1)
+    redchi = chi2/(N - nvarys)
+    sm = np.sqrt(var_m*redchi)
+    sb = np.sqrt(var_b*redchi)
+    return m, b, sm, sb, redchi
+
+def find_sweep_branches(B, tolerance=0.):
+    """Split a field sweep into branches of monotone B.
+
+    Returns a list of (kind, loop, slice) with kind being "virgin",
+    "descending" or "ascending" and loop counting the hysteresis loops,
+    starting with 0. Every point belongs to exactly one branch, a turning
+    point starts the next branch. Reversals of the field that span less than
+    tolerance are treated as noise and do not split a branch.
+    """
+    B = np.asarray(B)
+    N = len(B)
+    if N < 2:
+        return [("ascending", 0, slice(0, N))]
+
+    # direction of every step, steps without change continue the last direction
+    direction = np.sign(np.diff(B))
+    nonzero = np.nonzero(direction)[0]
+    if len(nonzero) == 0:
+        return [("ascending", 0, slice(0, N))]
+    last_nonzero = np.maximum.accumulate(np.where(direction != 0, np.arange(N-1), 0))
+    direction = direction[last_nonzero]
+    direction[:nonzero[0]] = direction[nonzero[0]]
+
+    starts = [0] + [int(i) for i in np.nonzero(np.diff(direction))[0] + 1] + [N]
+    if tolerance > 0:
+        starts = merge_reversals(B, starts, tolerance)
+        signs = [np.sign(B[end-1] - B[start]) or 1.\
+                 for start, end in zip(starts[:-1], starts[1:])]
+    else:
+        signs = [direction[start] for start in starts[:-1]]
+    branches = [[starts[i], starts[i+1], signs[i]] for i in range(len(starts) - 1)]
+
+    result = []
+    loop = 0
+    for i, (start, end, sign) in enumerate(branches):
+        if i == 0 and len(branches) > 1 and\
+           abs(B[start]) <= 0.1*np.max(np.abs(B)):
+            kind = "virgin"
+        elif sign < 0:
+            kind = "descending"
+        else:
+            kind = "ascending"
+        if kind == "descending" and i > 0 and result[-1][0] == "ascending":
+            loop += 1
+        result.append((kind, loop, slice(start, end)))
+    return result
+
+def merge_reversals(B, starts, tolerance):
+    """Turning points of B with reversals below tolerance removed.
+
+    starts are the indices of all local extremes of B as branch starts
+    (with 0 and len(B)). The direction only changes when B moved back by more
+    than tolerance from the last extreme, so noise on a slow sweep or a field
+    hold does not split a branch.
+    """
+    Bl = B.tolist()
+    turns = []
+    sign = 0
+    hi = lo = ext = 0
+    for i in starts[1:-1] + [len(Bl) - 1]:
+        if sign == 0:
+            if Bl[i] > Bl[hi]:
+                hi = i
+            if Bl[i] < Bl[lo]:
+                lo = i
+            if Bl[hi] - Bl[lo] > tolerance:
+                sign = 1 if hi > lo else -1
+                ext = hi if sign > 0 else lo
+        elif sign*(Bl[i] - Bl[ext]) > 0:
+            ext = i
+        elif sign*(Bl[ext] - Bl[i]) > tolerance:
+            turns.append(ext)
+            sign = -sign
+            ext = i
+    return [0] + turns + [len(Bl)]
+
+def sweep_tolerance(B, n_sigma=10.):
+    """Tolerance for find_sweep_branches from the noise of the field B.
+
+    The noise is estimated from the median absolute second difference of B,
+    which is insensitive to the sweep rate and to the few turning points.
+    Reversals below n_sigma times the noise are treated as noise, at most
+    1 % of the field range.
+    """
+    B = np.asarray(B)
+    if len(B) < 3:
+        return 0.
+    d2B = np.diff(B, 2)
+    sigma = 1.4826*np.median(np.abs(d2B - np.median(d2B)))/np.sqrt(6.)
+    return min(n_sigma*sigma, 0.01*(np.max(B) - np.min(B)))
+
+def find_idx_nearest_vals(array, values, idx_sorted=None):
+    """Index of the nearest element of array for every element of values.
+
+    The sort index np.argsort(array) can be passed as idx_sorted to
+    search the same array many times without sorting it again.
+    """
+    if idx_sorted is None:
+        idx_sorted = np.argsort(array)
+    sorted_array = np.array(array[idx_sorted])
+    N = len(array)
+    idx = np.searchsorted(sorted_array, values, side="left")
+    idx_left = np.clip(idx - 1, 0, N - 1)
+    idx_right = np.clip(idx, 0, N - 1)
+    take_left = np.abs(values - sorted_array[idx_left]) <\
+                np.abs(values - sorted_array[idx_right])
+    idx_nearest = np.where(take_left, idx_left, idx_right)
+    idx_nearest[idx >= N] = N - 1
+    idx_nearest[idx == 0] = 0
+    return idx_sorted[idx_nearest]
+
+class StageProfiler():
+    """Wall time and peak memory of named processing stages.
+
+    Stages are timed with start_stage/end_stage or the stage context manager
+    and may be nested. With trace_memory the peak memory is traced with
+    tracemalloc, so only allocations made by Python and numpy are counted.
+    Tracing slows down the stages, so their times are then too long. A
+    disabled profiler does nothing.
+    """
+    def __init__(self, enabled=False, report_path=None, trace_memory=False):
+        self.enabled = enabled
+        self.report_path = report_path
+        self.trace_memory = trace_memory
+        self.records = []
+        self.running = []
+
+    def start_stage(self, name):
+        if not self.enabled:
+            return
+        current = 0
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            peak = tracemalloc.get_traced_memory()[1]
+            for stage in self.running:
+                stage["peak"] = max(stage["peak"], peak)
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+        self.running.append({"name": name, "start": time.perf_counter(),\
+                             "memory": current, "peak": current})
+
+    def end_stage(self):
+        if not self.enabled or len(self.running) == 0:
+            return
+        end = time.perf_counter()
+        if self.trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            for stage in self.running:
+                stage["peak"] = max(stage["peak"], peak)
+        stage = self.running.pop()
+        record = {"name": stage["name"], "depth": len(self.running),\
+                  "seconds": end - stage["start"]}
+        if self.trace_memory:
+            record["peak_MiB"] = (stage["peak"] - stage["memory"])/2.**20
+        self.records.append(record)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        self.start_stage(name)
+        try:
+            yield
+        finally:
+            self.end_stage()
+
+    def summary(self):
+        """Records of the stages summed up by name, in order of first use."""
+        summary = {}
+        for record in self.records:
+            if not record["name"] in summary:
+                summary[record["name"]] = {"calls": 0, "seconds": 0.}
+                if self.trace_memory:
+                    summary[record["name"]]["peak_MiB"] = 0.
+            entry = summary[record["name"]]
+            entry["calls"] += 1
+            entry["seconds"] += record["seconds"]
+            if self.trace_memory:
+                entry["peak_MiB"] = max(entry["peak_MiB"], record["peak_MiB"])
+        return summary
+
+    def print_summary(self):
+        print("\nProfile of " + os.path.basename(sys.argv[0]) + ":")
+        if self.trace_memory:
+            print("Memory traced with tracemalloc, the times include its overhead.")
+            print("stage".ljust(24) + "calls".rjust(8) + "time / s".rjust(12) +\
+                  "peak / MiB".rjust(14))
+        else:
+            print("stage".ljust(24) + "calls".rjust(8) + "time / s".rjust(12))
+        for name, entry in self.summary().items():
+            line = name.ljust(24) + str(entry["calls"]).rjust(8) +\
+                   ("%.4f" % entry["seconds"]).rjust(12)
+            if self.trace_memory:
+                line += ("%.2f" % entry["peak_MiB"]).rjust(14)
+            print(line)
+
+    def save_report(self, report_path):
+        report = {"script": os.path.basename(sys.argv[0]),
+                  "argv": sys.argv[1:],
+                  "created": time.strftime("%c"),
+                  "memory_traced": self.trace_memory,
+                  "summary": self.summary(),
+                  "stages": self.records}
+        report_file = open(report_path, "w")
+        json.dump(report, report_file, indent=2)
+        report_file.close()
+        print("Saved profile to", report_path)
+
+    def finish(self):
+        while len(self.running) > 0:
+            self.end_stage()
+        if len(self.records) == 0:
+            return
+        self.print_summary()
+        if self.report_path is not None:
+            self.save_report(self.report_path)
+
+def get_profiler():
+    """Profiler set up by -profile (or --profile), -profile_memory and
+    -profile_report FILE.
+
+    -profile only times the stages, -profile_memory also traces their peak
+    memory. An enabled profiler prints its summary when the script exits.
+    """
+    report_path = None
+    if "-profile_report" in sys.argv:
+        report_path = sys.argv[sys.argv.index("-profile_report") + 1]
+    trace_memory = "-profile_memory" in sys.argv
+    enabled = "-profile" in sys.argv or "--profile" in sys.argv or\
+              trace_memory or report_path is not None
+    profiler = StageProfiler(enabled, report_path, trace_memory)
+    if enabled:
+        atexit.register(profiler.finish)
+    return profiler
+
+def show_plots():
+    """False if plots are only saved, selected by -noshow (or --no-show)."""
+    return not ("-noshow" in sys.argv or "--no-show" in sys.argv)
+
+def select_plot_backend(show=None):
+    """Select the non-interactive Agg backend if plots are not shown.
+
+    show overrides -noshow, False for steps that only save plots. Has to be
+    called before matplotlib.pyplot is imported, so that no display is needed.
+    """
+    if show is None:
+        show = show_plots()
+    if not show:
+        import matplotlib
+        matplotlib.use("Agg")
+
+def pyplot(show=None):
+    """matplotlib.pyplot with the backend selected by select_plot_backend.
+
+    pyplot is only imported on first use, so the scripts start fast for
+    steps without plots.
+    """
+    select_plot_backend(show)
+    import matplotlib.pyplot as plt
+    return plt
+
+class VSMFile():
+    """Loading and saving of .xye files, independent of the command line."""
+    def __init__(self, use_cache=False, precision=None, profiler=None):
         self.version = 1.1
-        self.n_args = len(sys.argv) - 1
-        self.get_args()
-        if "-help" in sys.argv or "-h" in sys.argv:
-            self.help()
-            sys.exit()
-            
-    def get_args(self):
-        self.arg_dict = {}
-        for ip, param in enumerate(sys.argv):
-            if param.startswith("-"):
-                jp = ip + 1
-                param_list = []
-                while jp <= self.n_args and not sys.argv[jp].startswith("-"):
-                    param_list.append(sys.argv[jp])
-                    jp += 1
-                if len(param_list) == 1:
-                    param_list = param_list[0]
-                self.arg_dict[param[1:]] = param_list
-            else:
-                continue
-                
-    def help(self):
-        print("Help is not defined.")
+        self.use_cache = use_cache
+        self.precision = precision
+        if profiler is None:
+            profiler = StageProfiler()
+        self.profiler = profiler
+
+    def stage(self, name):
+        """Context manager profiling the enclosed code as stage name."""
+        return self.profiler.stage(name)
     
     def get_data_from_file(self, filepath):
+        stat = os.stat(filepath)
+        if self.use_cache:
+            cached_data = self.load_xye_cache(filepath, stat)
+            if cached_data is not None:
+                return cached_data
+
         datafile = open(filepath, "r")
         B = []
         M = []
@@ -36,8 +334,7 @@ class VSMClass():
         Mraw = []
         sMraw = []
         header = ""
-        self.Bunit = ""
-        self.Munit = ""
+        units = {"Bunit": "", "Munit": ""}
         last_line = ""
         loading_header = True
         for line in datafile:
@@ -50,13 +347,13 @@ class VSMClass():
                 split_line = line.strip().split("#")[1].split("\t")
                 for element in split_line:
                     if "B /" in element or "B_sub /" in element or "B_res /" in element:
-                        self.Bunit = element.split("/")[1].strip()
+                        units["Bunit"] = element.split("/")[1].strip()
                     elif "M /" in element or "M_sub /" in element or "B_res /" in element:
-                        self.Munit = element.split("/")[1].strip()
+                        units["Munit"] = element.split("/")[1].strip()
                     elif "B_raw /" in element:
-                        self.Brawunit = element.split("/")[1].strip()
+                        units["Brawunit"] = element.split("/")[1].strip()
                     elif "M_raw /" in element:
-                        self.Mrawunit = element.split("/")[1].strip()
+                        units["Mrawunit"] = element.split("/")[1].strip()
                 continue
             
             if line.startswith("#") or line.strip() == "":
@@ -69,16 +366,102 @@ class VSMClass():
             sM.append(float(splitline[2]))
             Mraw.append(float(splitline[-2]))
             sMraw.append(float(splitline[-1]))
+        datafile.close()
+        for unit_name in units:
+            setattr(self, unit_name, units[unit_name])
+        if self.use_cache:
+            self.save_xye_cache(filepath, stat, B, M, sM, Mraw, sMraw,\
+                                header, units)
         return B, M, sM, Mraw, sMraw, header
+
+    def xye_cache_path(self, filepath):
+        return filepath + ".cache.npz"
+
+    def load_xye_cache(self, filepath, stat):
+        """Load data from binary cache, None if missing or stale."""
+        cache_path = self.xye_cache_path(filepath)
+        if not os.path.isfile(cache_path):
+            return None
+        try:
+            cache = np.load(cache_path, allow_pickle=False)
+            info = json.loads(str(cache["info"]))
+            if info["version"] != XYE_CACHE_VERSION or\
+               info["size"] != stat.st_size or\
+               info["mtime_ns"] != stat.st_mtime_ns:
+                return None
+            B, M, sM, Mraw, sMraw = cache["data"]
+        except (OSError, ValueError, KeyError):
+            return None
+        for unit_name in info["units"]:
+            setattr(self, unit_name, info["units"][unit_name])
+        return B, M, sM, Mraw, sMraw, info["header"]
+
+    def save_xye_cache(self, filepath, stat, B, M, sM, Mraw, sMraw,\
+                       header, units):
+        info = {"version": XYE_CACHE_VERSION,
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "header": header,
+                "units": units}
+        cache_path = self.xye_cache_path(filepath)
+        tmp_path = cache_path + ".tmp"
+        try:
+            cache_file = open(tmp_path, "wb")
+            np.savez(cache_file, data=np.array([B, M, sM, Mraw, sMraw]),\
+                     info=np.array(json.dumps(info)))
+            cache_file.close()
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            print("Could not write cache for", filepath)
     
     def load_xye_vsmfile(self, filepath):
-        B, M, sM, Mraw, sMraw, header = self.get_data_from_file(filepath)
+        with self.stage("load"):
+            B, M, sM, Mraw, sMraw, header = self.get_data_from_file(filepath)
         self.B = np.asarray(B)
         self.M = np.asarray(M)
         self.sM = np.asarray(sM)
         self.Mraw = np.asarray(Mraw)
         self.sMraw = np.asarray(sMraw)
         self.header = header
+        self.branches = find_sweep_branches(self.B, sweep_tolerance(self.B))
+
+    def format_columns(self, columns, prefix=""):
+        """Format equally long data columns as tab separated text rows.
+
+        Values are written like str() does unless a precision (number of
+        significant digits) is set by -prec.
+        """
+        data = np.column_stack(columns)
+        if self.precision is None:
+            value_format = "%s"
+        else:
+            value_format = "%." + str(self.precision) + "g"
+        row_format = prefix + "\t".join([value_format]*data.shape[1]) + "\n"
+        return (row_format*data.shape[0]) % tuple(data.ravel().tolist())
+
+    def save_xye_file(self, filepath, header, columns, chunksize=10000):
+        """Write header and data columns to filepath.
+
+        Data is written to a temporary file first, which replaces filepath
+        only after it was written completely.
+        """
+        with self.stage("write"):
+            tmp_path = filepath + ".tmp"
+            save_data = open(tmp_path, "w")
+            try:
+                save_data.write(header)
+                for i in range(0, len(columns[0]), chunksize):
+                    save_data.write(self.format_columns(\
+                        [column[i:i+chunksize] for column in columns]))
+                save_data.close()
+            except:
+                save_data.close()
+                os.remove(tmp_path)
+                raise
+            os.replace(tmp_path, filepath)
+
+    def find_idx_nearest_vals(self, array, values, idx_sorted=None):
+        return find_idx_nearest_vals(array, values, idx_sorted)
 
     def find_idx_nearest_val(self, array, value):
         idx_sorted = np.argsort(array)
@@ -96,4 +479,36 @@ class VSMClass():
                 return idx_nearest
             else:
                 idx_nearest = idx_sorted[idx]
-            return idx_nearest
\ No newline at end of file
+            return idx_nearest
+
+class VSMClass(VSMFile):
+    def __init__(self):
+        self.n_args = len(sys.argv) - 1
+        if "-prec" in sys.argv:
+            precision = int(sys.argv[sys.argv.index("-prec") + 1])
+        else:
+            precision = None
+        VSMFile.__init__(self, "-cache" in sys.argv, precision, get_profiler())
+        self.show_plots = show_plots()
+        self.get_args()
+        if "-help" in sys.argv or "-h" in sys.argv:
+            self.help()
+            sys.exit()
+            
+    def get_args(self):
+        self.arg_dict = {}
+        for ip, param in enumerate(sys.argv):
+            if param.startswith("-"):
+                jp = ip + 1
+                param_list = []
+                while jp <= self.n_args and not sys.argv[jp].startswith("-"):
+                    param_list.append(sys.argv[jp])
+                    jp += 1
+                if len(param_list) == 1:
+                    param_list = param_list[0]
+                self.arg_dict[param[1:]] = param_list
+            else:
+                continue
+                
+    def help(self):
+        print("Help is not defined.")
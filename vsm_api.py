@@ -0,0 +1,262 @@
+import numpy as np
+from vsm import VSMFile, weighted_linear_fit, find_idx_nearest_vals,\
+                find_sweep_branches, sweep_tolerance
+from vsm_dataextract import VHDReader
+
+# Processing steps of the VSM scripts working on arrays in memory. The
+# command line scripts (vsm_dataextract.py, vsm_substract.py, vsm_excess.py,
+# vsm_rescale.py) use the functions below, the stages at the end of this file
+# chain them on VSMData without writing intermediate .xye files:
+#
+#   data = extract("sample.VHD", M_unit="memu")
+#   data = substract_slope(data, 0.02)
+#   data = correct_excess(data, 1., 1.8)
+#   data = rescale(data, 2.5, "kAm-1")
+#   data.save("sample_processed.xye")
+
+def substract_linear_background(B, M, sM, slope, sf=1., sigma_slope=0.):
+    """Substract sf*slope*B from M, sigma_slope adds a systematic error."""
+    M_sub = M - sf*slope*B
+    sM_sub = np.sqrt(sM**2 + (sf*sigma_slope*B)**2)
+    return M_sub, sM_sub
+
+def interpolate_background(B1, B2, M2, sM2, idx_sorted2=None):
+    """Background 2 at the fields B1.
+
+    Background points that match B1 are used directly, otherwise the
+    background is interpolated linearly between the nearest point and its
+    neighbor in measurement order. Fields outside the range of B2 take the
+    nearest end point, extrapolating from the closely spaced points at a
+    turning point would blow up the error.
+    """
+    B1 = np.asarray(B1)
+    NB2 = len(B2)
+    nearest_idx = find_idx_nearest_vals(B2, B1, idx_sorted2)
+    Bnear = B2[nearest_idx]
+    exact = np.isclose(Bnear, B1)
+    inside = (np.min(B2) <= B1) & (B1 <= np.max(B2))
+
+    Binterpolated = np.where(exact | ~inside, Bnear, B1)
+    Minterpolated = M2[nearest_idx]
+    sMinterpolated = sM2[nearest_idx]
+
+    # linear interpolation of B2 at the remaining B1 values:
+    interp = ~exact & inside
+    Bval = B1[interp]
+    near = nearest_idx[interp]
+    low_idx = np.where(Bnear[interp] < Bval, near, near - 1)
+    low_idx[near == 0] = 0
+    low_idx[near == NB2-1] = NB2-2
+    high_idx = low_idx + 1
+
+    dB = (B2[high_idx] - B2[low_idx])
+    slope = (M2[high_idx] - M2[low_idx])/dB
+    sig_slope = np.sqrt(sM2[high_idx]**2 + sM2[low_idx]**2)/dB
+
+    Minterpolated[interp] = slope*(Bval - B2[low_idx]) + M2[low_idx]
+    sMinterpolated[interp] = np.sqrt(sM2[low_idx]**2 +\
+                                     (sig_slope*(Bval - B2[low_idx]))**2)
+    return Binterpolated, Minterpolated, sMinterpolated
+
+def match_branch(branch, B1, branches2, B2):
+    """Slice of the background branch that was measured like branch of B1.
+
+    Preferred is the branch of the same kind in the same loop, then the same
+    kind, then the same sweep direction. None if the background has no such
+    branch with at least two points.
+    """
+    kind, loop, branch_slice = branch
+    sign = np.sign(B1[branch_slice.stop-1] - B1[branch_slice.start])
+    candidates = [(kind2, loop2, slice2, np.sign(B2[slice2.stop-1] - B2[slice2.start]))\
+                  for kind2, loop2, slice2 in branches2 if slice2.stop - slice2.start > 1]
+    for matches in [lambda kind2, loop2, sign2: kind2 == kind and loop2 == loop,\
+                    lambda kind2, loop2, sign2: kind2 == kind,\
+                    lambda kind2, loop2, sign2: sign2 == sign]:
+        for kind2, loop2, slice2, sign2 in candidates:
+            if matches(kind2, loop2, sign2):
+                return slice2
+    return None
+
+def nearest_point_substraction(B1, M1, sM1, B2, M2, sM2, idx_sorted2=None,\
+                               branches1=None, branches2=None):
+    """Substract background 2 from data 1 at the fields B1.
+
+    Every sweep branch of data 1 is substracted with the matching branch of
+    the background (see match_branch), so that ascending and descending
+    branches are not mixed. Within the branch, background points that match
+    B1 are used directly, otherwise the background is interpolated (see
+    interpolate_background). The sort index of B2 and the branches of both
+    (see find_sweep_branches) can be passed to reuse them for several samples.
+    """
+    B1 = np.asarray(B1)
+    if idx_sorted2 is None:
+        idx_sorted2 = np.argsort(B2)
+    if branches1 is None:
+        branches1 = find_sweep_branches(B1, sweep_tolerance(B1))
+    if branches2 is None:
+        branches2 = find_sweep_branches(B2, sweep_tolerance(B2))
+
+    Binterpolated = np.empty(len(B1))
+    Minterpolated = np.empty(len(B1))
+    sMinterpolated = np.empty(len(B1))
+    for branch in branches1:
+        slice1 = branch[2]
+        if slice1.stop == slice1.start:
+            continue
+        slice2 = match_branch(branch, B1, branches2, B2)
+        if slice2 is None:
+            slice2 = slice(0, len(B2))
+        else:
+            # include the turning points shared with the neighbouring branches
+            slice2 = slice(max(slice2.start - 1, 0), min(slice2.stop + 1, len(B2)))
+        # sort index of the background branch, taken from the full sort index
+        in_branch = (slice2.start <= idx_sorted2) & (idx_sorted2 < slice2.stop)
+        Binterpolated[slice1], Minterpolated[slice1], sMinterpolated[slice1] =\
+            interpolate_background(B1[slice1], B2[slice2], M2[slice2], sM2[slice2],\
+                                   idx_sorted2[in_branch] - slice2.start)
+
+    Msubstracted = M1 - Minterpolated
+    sMsubstracted = np.sqrt(sM1**2 + sMinterpolated**2)
+
+    return Binterpolated, Minterpolated, sMinterpolated,\
+           Msubstracted, sMsubstracted
+
+def fit_excess(B, M, sM, min_B, max_B):
+    """Fit straight lines to both branches between min_B < |B| < max_B.
+
+    Returns a dict with the fit of the upper (B > 0) and lower branch, the
+    weighted mean slope m and shift n, and M_corr = M - m*B.
+    """
+    B_up_slice = np.logical_and(min_B<B, B<max_B)
+    B_down_slice = np.logical_and(-max_B<B, B<-min_B)
+    fit = {"N_up": np.count_nonzero(B_up_slice),
+           "N_low": np.count_nonzero(B_down_slice)}
+
+    fit["mup"], fit["nup"], fit["smup"], fit["snup"], fit["redchi_up"] =\
+        weighted_linear_fit(B[B_up_slice], M[B_up_slice], sM[B_up_slice])
+    fit["mlow"], fit["nlow"], fit["smlow"], fit["snlow"], fit["redchi_low"] =\
+        weighted_linear_fit(B[B_down_slice], M[B_down_slice], sM[B_down_slice])
+
+    sm = 1./fit["smup"]**2 + 1./fit["smlow"]**2
+    fit["m"] = (fit["mup"]/fit["smup"]**2 + fit["mlow"]/fit["smlow"]**2) / sm
+    fit["sm"] = np.sqrt(1./sm)
+
+    sn = 1./fit["snup"]**2 + 1./fit["snlow"]**2
+    fit["n"] = (fit["nup"]/fit["snup"]**2 - fit["nlow"]/fit["snlow"]**2) / sn
+    fit["sn"] = np.sqrt(1./sn)
+
+    fit["M_corr"] = M - fit["m"]*B
+    fit["sM_corr"] = sM
+    return fit
+
+def rescale_magnetization(M, sM, scalefactor, sigma_scale=0.):
+    """Divide M by scalefactor, sigma_scale is the error of the scalefactor."""
+    M_res = M/scalefactor
+    sM_res = sM/scalefactor
+    sM_res = np.sqrt(sM_res**2 + (M_res*sigma_scale/scalefactor)**2)
+    return M_res, sM_res
+
+
+class VSMData():
+    """Field sweep of one sample in memory.
+
+    B, M and sM are the processed data, Mraw and sMraw the signal as
+    extracted from the VHD file. header holds the comment lines of the .xye
+    file without the column names, provenance one dict per processing stage.
+    """
+    def __init__(self, B, M, sM, Mraw, sMraw, header="", Bunit="", Munit="",\
+                 Mrawunit="", provenance=None):
+        self.B = np.asarray(B)
+        self.M = np.asarray(M)
+        self.sM = np.asarray(sM)
+        self.Mraw = np.asarray(Mraw)
+        self.sMraw = np.asarray(sMraw)
+        self.header = header
+        self.Bunit = Bunit
+        self.Munit = Munit
+        self.Mrawunit = Mrawunit
+        if provenance is None:
+            provenance = []
+        self.provenance = provenance
+
+    def processed(self, stage, M, sM, parameters, Munit=None):
+        """New VSMData with M, sM replaced by the result of stage."""
+        header = self.header + "#" + stage + ": " +\
+                 ", ".join([name + " = " + str(value)\
+                            for name, value in parameters.items()]) + "\n"
+        provenance = self.provenance + [dict(stage=stage, **parameters)]
+        if Munit is None:
+            Munit = self.Munit
+        return VSMData(self.B, M, sM, self.Mraw, self.sMraw, header,\
+                       self.Bunit, Munit, self.Mrawunit, provenance)
+
+    def column_header(self):
+        return "#B / " + self.Bunit + "\tM / " + self.Munit +\
+               "\tsM / " + self.Munit + "\tM_raw / " + self.Mrawunit +\
+               "\tsM_raw / " + self.Mrawunit + "\n"
+
+    def save(self, filepath, precision=None):
+        VSMFile(precision=precision).save_xye_file(filepath,\
+            self.header + self.column_header(),\
+            [self.B, self.M, self.sM, self.Mraw, self.sMraw])
+
+def load(filepath, use_cache=False):
+    """Load an .xye file written by the VSM scripts."""
+    reader = VSMFile(use_cache=use_cache)
+    B, M, sM, Mraw, sMraw, header = reader.get_data_from_file(filepath)
+    return VSMData(B, M, sM, Mraw, sMraw, header, reader.Bunit, reader.Munit,\
+                   getattr(reader, "Mrawunit", ""),\
+                   [{"stage": "load", "filepath": filepath}])
+
+def extract(vhd_path, B_column="Applied Field", M_column="Raw Signal Mx",\
+            B_unit="T", M_unit="memu", noise_level=5e-3, V=None,\
+            imagecorr_table=None, imagecorr_source=None, use_index=True,\
+            verbose=False):
+    """Extract B and M of a VHD file like vsm_dataextract.py does.
+
+    imagecorr_table = (B, factor) replaces the image correction table of the
+    VHD file, imagecorr_source names its origin in the header. Raises
+    ValueError for invalid parameters and IOError if vhd_path is missing,
+    verbose prints the progress of the extraction.
+    """
+    pdict = {"B_column": B_column, "M_column": M_column, "B_unit": B_unit,\
+             "M_unit": M_unit, "noise_level": noise_level}
+    if V is not None:
+        pdict["V"] = V
+    if imagecorr_source is not None:
+        pdict["imagecorr_file"] = imagecorr_source
+    reader = VHDReader(pdict, use_index, imagecorr_table, verbose=verbose)
+    reader.data_string = "#Loading data from file: " + vhd_path + "\n"
+    B, M, sM, M_raw, sM_raw, M_rawunit, B_imagecorr, imagecorr_factor =\
+        reader.load_data(vhd_path)
+    header = reader.xye_header(M_rawunit)
+    header = header[:header.rindex("#B / ")]
+    return VSMData(B, M, sM, M_raw, sM_raw, header, B_unit, M_unit, M_rawunit,\
+                   [dict(stage="extract", vhd_path=vhd_path, **pdict)])
+
+def substract_slope(data, slope, sf=1., sigma_slope=0.):
+    M_sub, sM_sub = substract_linear_background(data.B, data.M, data.sM,\
+                                                slope, sf, sigma_slope)
+    return data.processed("substract_slope", M_sub, sM_sub,\
+        {"slope": slope, "sf": sf, "sigma_slope": sigma_slope})
+
+def substract_background(data, background, sf=1., idx_sorted_bg=None):
+    """Point by point substraction of the VSMData background."""
+    Binterpolated, Minterpolated, sMinterpolated, M_sub, sM_sub =\
+        nearest_point_substraction(data.B, data.M, data.sM, background.B,\
+                                   sf*background.M, sf*background.sM,\
+                                   idx_sorted_bg)
+    return data.processed("substract_background", M_sub, sM_sub,\
+        {"sf": sf, "background": background.provenance})
+
+def correct_excess(data, min_B, max_B):
+    fit = fit_excess(data.B, data.M, data.sM, abs(min_B), abs(max_B))
+    return data.processed("correct_excess", fit["M_corr"], fit["sM_corr"],\
+        {"min_B": abs(min_B), "max_B": abs(max_B), "m": fit["m"],\
+         "sm": fit["sm"], "n": fit["n"], "sn": fit["sn"]})
+
+def rescale(data, scalefactor, Munit, sigma_scale=0.):
+    M_res, sM_res = rescale_magnetization(data.M, data.sM, scalefactor,\
+                                          sigma_scale)
+    return data.processed("rescale", M_res, sM_res,\
+        {"scalefactor": scalefactor, "sigma_scale": sigma_scale}, Munit)
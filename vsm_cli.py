@@ -0,0 +1,59 @@
+import sys, os.path, importlib, runpy
+
+# Single entry point for the VSM scripts: python vsm_cli.py COMMAND [..]
+# (or the vsm wrapper). Only the module of the selected command is imported,
+# so matplotlib is not loaded for -h or for steps without plots.
+#
+# command: (module, class run by the command or None for the __main__ block
+#           of the module, arguments put in front, description)
+COMMANDS = {
+    "extract": ("vsm_dataextract", "VSM_Extract", ["-extract"],\
+                "Extract .xye files with an extraction parameter file."),
+    "gen": ("vsm_dataextract", "VSM_GenExtract", [],\
+            "Generate an extraction parameter file for VHD files."),
+    "substract": ("vsm_substract", "VSM_Substract", [],\
+                  "Substract a linear or measured background."),
+    "excess": ("vsm_excess", "VSM_Excess", [],\
+               "Correct excess slope at high fields."),
+    "rescale": ("vsm_rescale", "VSM_Rescale", [],\
+                "Rescale the magnetization to a new unit."),
+    "pipeline": ("vsm_pipeline", "VSM_Pipeline", [],\
+                 "Run all stages of a pipeline file, with caching."),
+    "plot": ("plot_xye", None, [],\
+             "Plot .xye files."),
+    "fit": ("fit_linear_xye", None, [],\
+            "Fit a straight line to .xye data."),
+}
+
+def print_help():
+    print("python vsm_cli.py COMMAND [..]")
+    print("\nCommands:")
+    for command, (module, classname, prefix_args, description) in COMMANDS.items():
+        print(command + " \t -- \t " + description)
+    print("\nHelp of a command: python vsm_cli.py COMMAND -h")
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if len(argv) < 1 or argv[0] in ["-h", "-help", "--help"]:
+        print_help()
+        sys.exit()
+    if not argv[0] in COMMANDS:
+        print("Unknown command: " + argv[0])
+        print_help()
+        sys.exit(1)
+
+    module, classname, prefix_args, description = COMMANDS[argv[0]]
+    args = argv[1:]
+    if len(args) == 0 and argv[0] == "extract":
+        args = ["-h"]
+    # the scripts read their arguments from sys.argv
+    sys.argv = [os.path.join(os.path.dirname(os.path.abspath(__file__)), module + ".py")] +\
+               prefix_args + args
+    if classname is None:
+        runpy.run_module(module, run_name="__main__")
+    else:
+        getattr(importlib.import_module(module), classname)()
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,9 @@
 import numpy as np
-import sys, os, os.path, time, glob
-from vsm import VSMClass
+import sys, os, os.path, time, glob, io, json, mmap
+import contextlib, multiprocessing
+from vsm import VSMClass, VSMFile, pyplot
+
+VHD_INDEX_VERSION = 1
 
 class VSM_GenExtract(VSMClass):
     def __init__(self):
@@ -31,6 +34,7 @@ class VSM_GenExtract(VSMClass):
         print("\t-save SAVETOFILE [SAVETOFILE2 SAVETOFILE3 ...]")
         print("\t-V V \t --\t volume to set ")
         print("\t-generate \t -- \t Only generate, don't extract directly.")
+        print("\t-j N \t -- \t Extract N files in parallel.")
         print("")
 
     def get_multiple_args(self, arg):
@@ -132,6 +136,7 @@ B_unit		T			#  convert to which magnetic field unit, can choose between: T, mT,
 M_unit		"+self.munit+"			#  convert to which magnetization unit, can choose between: Am2, memu, emu, Am-1, kAm-1\n\
 noise_level	5e-3			#  noise level of VSM in memu\n\
 V		"+self.V+"			#  in mm3 (µL), needed if M_unit is A/m, kA/m, volume of measured magnetic material\n\
+#imagecorr_file	imagecorr.dat		#  optional: use this image correction table for all files, created from first VHD file if missing\n\
 \n\
 # tell where to load data from and where to save the xy columns to\n\
 # if multiple pairs are given, multiple files are created\n\n\
@@ -148,67 +153,38 @@ V		"+self.V+"			#  in mm3 (µL), needed if M_unit is A/m, kA/m, volume of measur
 
 
 
-class VSM_Extract(VSMClass):
-    def __init__(self, filepath=None):
-        super().__init__()
-        
-        if self.n_args < 1 and filepath is None:
-            print("Give path to file containing parameters for VSM "+\
-                  "data extraction as argument.")
-            print("Usage of vsm_dataextract.py for data extraction:")
-            self.help()
-            sys.exit()
-        if filepath is not None:
-            self.filepath = filepath
-        
-        self.B_units = {"Oe": 1E4, "mT": 1E3, "T": 1}
-        self.M_units = {"Am2": 1E-6, "emu": 1E-3, "memu": 1, "Am-1": 1E-6,\
-                        "kAm-1":1E-9}
+class VHDReader(VSMFile):
+    """Extraction of B and M from Lakeshore VHD files.
 
-        self.log_string = ""
-        self.load_param_file()
+    Works without command line, the parameters are given as dict with the
+    entries of the extraction parameter file (see VSM_GenExtract).
+    """
+    B_units = {"Oe": 1E4, "mT": 1E3, "T": 1}
+    M_units = {"Am2": 1E-6, "emu": 1E-3, "memu": 1, "Am-1": 1E-6,\
+               "kAm-1":1E-9}
 
-    def help(self):
-        print("python vsm_dataextract.py -extract parameter_file [..]")
-        print("Possible parameters:")
-        print("\tNone")
-        print("")
+    verbose = True
 
-    def get_args(self):
-        if "-extract" in sys.argv:
-            self.filepath = sys.argv[sys.argv.index("-extract") + 1]
+    def __init__(self, pdict, use_index=True, imagecorr_table=None,\
+                 precision=None, profiler=None, verbose=True):
+        VSMFile.__init__(self, precision=precision, profiler=profiler)
+        self.verbose = verbose
+        self.use_index = use_index
+        self.imagecorr_table = imagecorr_table
+        self.log_string = ""
+        self.set_parameters(pdict)
 
-    def load_param_file(self):
-        self.pdict = {}
-        self.samplelist = []
-        #  Start Reading parameter file
-        start_load_datapaths = False
-        pfile = open(self.filepath, "r")
-        self.log_string += "#Loaded parameter file: " + str(self.filepath) + "\n"
-        for line in pfile:
-            if line.startswith('#'):  # skip comment lines which start with #
-                continue
-            if '@start' in line:  # flag switches from parameter reading to datapaths reading
-                start_load_datapaths = True
-                continue
-            if '@end' in line:  # flag switches from parameter reading to datapaths reading
-                start_load_datapaths = False
-                continue
-            split_line = line.split('#')[0].strip().split(maxsplit=1)  # remove everything after # and split between first empty spaces/tabs
-            if len(split_line) < 2:
-                continue
-            if not start_load_datapaths:  # First load parameters, structure Name Value, then load paths
-                self.pdict[split_line[0]] = split_line[1]
-            else:
-                if not os.path.isfile(split_line[0]):  # does sample file exist?
-                    sys.exit("Datapath does not exist. Entered path: " + split_line[0])
-                self.samplelist.append((split_line[0], split_line[1]))
-        pfile.close()
+    def report(self, *message):
+        """Print progress, unless verbose is switched off."""
+        if self.verbose:
+            print(*message)
 
-        #  End of reading parameter file
+    def set_parameters(self, pdict):
+        """Check the extraction parameters, raises ValueError if invalid."""
+        self.pdict = pdict
         def check_if_parameter_loaded(pdict, pname, pdescription):
             if not pname in pdict:
-                sys.exit("Define parameter for " + pdescription +": " + pname)
+                raise ValueError("Define parameter for " + pdescription +": " + pname)
         check_if_parameter_loaded(self.pdict, "B_column", "column name of B")
         check_if_parameter_loaded(self.pdict, "M_column", "column name of M")
         check_if_parameter_loaded(self.pdict, "B_unit", "unit of B")
@@ -216,181 +192,306 @@ class VSM_Extract(VSMClass):
         check_if_parameter_loaded(self.pdict, "noise_level", "noiselevel of magnetometer")
 
         if not self.pdict["B_unit"] in self.B_units:  # check if B units are known
-            sys.exit("Define unit of B.")
+            raise ValueError("Define unit of B.")
         else:
             self.B_unit_factor = self.B_units[self.pdict["B_unit"]]
         
-        print("Desired unit of B: " +self.pdict["B_unit"])
+        self.report("Desired unit of B: " +self.pdict["B_unit"])
         self.log_string += "#Desired unit of B: " + self.pdict["B_unit"] + "\n"
-        print("Desired unit of M: " +self.pdict["M_unit"])
+        self.report("Desired unit of M: " +self.pdict["M_unit"])
         self.log_string += "#Desired unit of M: " + self.pdict["M_unit"] + "\n"
 
         if not self.pdict["M_unit"] in self.M_units:  # check if M units are known
-            sys.exit("Define unit of M.")
+            raise ValueError("Define unit of M.")
         else:
             self.M_unit_factor = self.M_units[self.pdict["M_unit"]]
             if self.pdict["M_unit"] in {"Am-1", "kAm-1"}:  # check if volume is entered correctly for rescaling
                 if not "V" in self.pdict:
-                    sys.exit("You selected " + self.pdict["M_unit"] + " as unit. You need to define the volume of the magnetic sample as parameter V.")
+                    raise ValueError("You selected " + self.pdict["M_unit"] + " as unit. You need to define the volume of the magnetic sample as parameter V.")
                 else:
                     try:
                         self.pdict["V"] = float(self.pdict["V"])
                     except ValueError:
-                        sys.exit("The entered volume is not a number.")
+                        raise ValueError("The entered volume is not a number.")
                     self.log_string += "#Unit of M needs volume for scale. Volume is set to: " + str(self.pdict["V"]) + "\n"
                     self.M_unit_factor /= (self.pdict["V"]*1e-9)
         self.log_string += "#Reading column for B: " + self.pdict["B_column"] + "\n"
         self.log_string += "#Reading column for M: " + self.pdict["M_column"] + "\n"
-        self.log_string += "#Estimate noise level: " + self.pdict["noise_level"] + " memu\n"
-    
-        for samplepair in self.samplelist:
-            self.data_string = "#Loading data from file: " + samplepair[0] + "\n"
-            self.data_string += "#Save data to file: " + samplepair[1] + "\n"
-            self.data_string += "#Extraction performed at: " +  time.strftime("%c") + "\n"
-            
-            B, M, sM, M_raw, sM_raw, M_rawunit, B_imagecorr, imagecorr_factor =\
-                        self.load_data(samplepair[0]) # Load Data
-            
-            #Save data 
-            save_data = open(samplepair[1], "w")
-            save_data.write("#Extracted data using VSM extraction tool v"+\
-                    str(self.version)+" \n")
-            save_data.write(self.log_string)
-            save_data.write(self.data_string)
-            
-            save_data.write("\n#B / "+self.pdict["B_unit"]+"\tM / "+self.pdict["M_unit"] +\
-                    "\tsM / "+self.pdict["M_unit"]+"\tM_raw / "+M_rawunit +"\tsM_raw / "+\
-                    M_rawunit + "\n")
-                    
-            for i, bval in enumerate(B):
-                save_data.write(str(bval) + "\t" + str(M[i]) + "\t" + str(sM[i]) +\
-                    "\t" + str(M_raw[i]) + "\t" + str(sM_raw[i]) + "\n")
-            save_data.close()
-                
-            print("Saved data from "+samplepair[0]+" to: " + samplepair[1])
-            print("\n")
-            
+        self.log_string += "#Estimate noise level: " + str(self.pdict["noise_level"]) + " memu\n"
+
+    def xye_header(self, M_rawunit):
+        header = "#Extracted data using VSM extraction tool v"+\
+                str(self.version)+" \n"
+        header += self.log_string
+        header += self.data_string
+        
+        header += "\n#B / "+self.pdict["B_unit"]+"\tM / "+self.pdict["M_unit"] +\
+                "\tsM / "+self.pdict["M_unit"]+"\tM_raw / "+M_rawunit +"\tsM_raw / "+\
+                M_rawunit + "\n"
+        return header
+
     def load_data(self, file_path):
-        B_col, M_col, B_rawunit, M_rawunit =\
-            self.load_columns(file_path, self.pdict["B_column"], self.pdict["M_column"])
-        B_raw, M_raw, B_imagecorr, imagecorr_factor =\
-            self.load_data_from_VHD_file(file_path, B_col, M_col)
+        if not os.path.isfile(file_path):
+            raise IOError("VHD file not found: " + file_path)
+        with self.stage("scan"):
+            content, sections = self.scan_VHD_file(file_path)
+        with self.stage("parse"):
+            B_col, M_col, B_rawunit, M_rawunit =\
+                self.load_columns(file_path, content, sections,\
+                                  self.pdict["B_column"], self.pdict["M_column"])
+            B_raw, M_raw, B_imagecorr, imagecorr_factor =\
+                self.load_data_from_VHD_file(file_path, content, sections,\
+                                             B_col, M_col)
+        if isinstance(content, mmap.mmap):
+            content.close()
         
+        self.log_conversion(B_rawunit, M_rawunit, B_imagecorr, imagecorr_factor)
+        B, M, sM, sM_raw = self.convert_data(B_raw, M_raw, B_rawunit, M_rawunit,\
+                                             B_imagecorr, imagecorr_factor)
+        self.report("Applied factor to change unit of magnetic field:", self.B_unit_factor / self.B_units[B_rawunit])
+        self.report("Applied factor to change unit of magnetization:", self.M_unit_factor / self.M_units[M_rawunit])
+        return B, M, sM, M_raw, sM_raw, M_rawunit, B_imagecorr, imagecorr_factor
+
+    def log_conversion(self, B_rawunit, M_rawunit, B_imagecorr, imagecorr_factor):
         self.data_string += "#Unit of B in data: " + B_rawunit + "\n"
         self.data_string += "#Changing unit by multiplying with factor: " + str(self.B_unit_factor / self.B_units[B_rawunit]) + "\n"
         self.data_string += "#Unit of M in data: " + M_rawunit + "\n"
         m_change_factor = self.M_unit_factor / self.M_units[M_rawunit]
         if not np.allclose(m_change_factor, 1):
             self.data_string += "#Changing unit by multiplying with factor: " + str(m_change_factor) + "\n"
-        M = M_raw * self.M_unit_factor / self.M_units[M_rawunit]
         
-        # image correct M_values
         if len(B_imagecorr) > 0:
-            for i, B_value in enumerate(B_raw):
-                B_value = abs(B_value)
-                if B_value < B_imagecorr[0]:
-                    continue
-                
-                if B_value >= B_imagecorr[-1]:
-                    corr_fac = imagecorr_factor[-1]
-                elif B_value == B_imagecorr[0]:
-                    corr_fac = imagecorr_factor[0]
-                else:
-                    for ib, B_imagecorrs in enumerate(B_imagecorr):
-                        if B_imagecorrs > B_value:
-                            dB = B_imagecorr[ib] - B_imagecorr[ib-1]
-                            corr_fac =\
-                                imagecorr_factor[ib-1] *(B_imagecorr[ib] - B_value)/dB +\
-                                imagecorr_factor[ib] *(B_value - B_imagecorr[ib-1])/dB
-                            break
-                M[i] *= corr_fac
-                
-
-            print("Applied image correction Factors to magnetization.")
+            self.report("Applied image correction Factors to magnetization.")
+            if self.imagecorr_table is not None:
+                self.data_string += "#Image correction table loaded from: " +\
+                    self.pdict.get("imagecorr_file", "<table passed in memory>") + "\n"
             self.data_string += "#Applied image correction factors to M by "+\
                                 "linear interpolation of following values\n"
             for i, bval in enumerate(B_imagecorr):
                 self.data_string += "#"+str(bval) + "\t" + str(imagecorr_factor[i]) + "\n"
         else:
-            print("Failed to load correction values.")
+            self.report("Failed to load correction values.")
             self.data_string += "#Failed to perform image correction\n"
-        
-        B = B_raw * self.B_unit_factor / self.B_units[B_rawunit]
-        
-        #sM in raw units
-        sM_raw = float(self.pdict["noise_level"]) * np.ones(len(M_raw)) * self.M_units[M_rawunit]/self.M_units["memu"]
-        
-        #sM in desired units
-        sM = sM_raw * self.M_unit_factor / self.M_units[M_rawunit]
-        print("Applied factor to change unit of magnetic field:", self.B_unit_factor / self.B_units[B_rawunit])
-        print("Applied factor to change unit of magnetization:", self.M_unit_factor / self.M_units[M_rawunit])
-        return B, M, sM, M_raw, sM_raw, M_rawunit, B_imagecorr, imagecorr_factor
 
-    def load_data_from_VHD_file(self, filename, B_column, M_column):
-        print("Loading", filename)
-        datafile = open(filename, 'r')
-        B = []
-        M = []
+    def convert_data(self, B_raw, M_raw, B_rawunit, M_rawunit,\
+                     B_imagecorr, imagecorr_factor):
+        with self.stage("unit conversion"):
+            M = M_raw * self.M_unit_factor / self.M_units[M_rawunit]
+            B = B_raw * self.B_unit_factor / self.B_units[B_rawunit]
+            
+            #sM in raw units
+            sM_raw = float(self.pdict["noise_level"]) * np.ones(len(M_raw)) * self.M_units[M_rawunit]/self.M_units["memu"]
+            
+            #sM in desired units
+            sM = sM_raw * self.M_unit_factor / self.M_units[M_rawunit]
         
+        # image correct M_values
+        if len(B_imagecorr) > 0:
+            with self.stage("image correction"):
+                M *= self.image_correction_factors(B_raw, B_imagecorr, imagecorr_factor)
+        return B, M, sM, sM_raw
+
+    def scan_VHD_file(self, filename):
+        """Memory-map VHD file and locate its sections.
+
+        Returns the file content and a dict with the byte ranges (start, end)
+        of the column table, the image correction table(s) and the data block.
+        The ranges are taken from the .idx sidecar file if it is still valid,
+        otherwise the file is scanned and the index is (re)written.
+        """
+        datafile = open(filename, 'rb')
+        stat = os.fstat(datafile.fileno())
+        if stat.st_size > 0:
+            content = mmap.mmap(datafile.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            content = b""
+        datafile.close()
+
+        sections = None
+        if self.use_index:
+            sections = self.load_VHD_index(filename, stat)
+        if sections is None:
+            self.report("Scanning", filename)
+            sections = self.find_VHD_sections(content)
+            if self.use_index:
+                self.save_VHD_index(filename, stat, sections)
+        else:
+            self.report("Using section index", self.VHD_index_path(filename))
+        return content, sections
+
+    def VHD_index_path(self, filename):
+        return filename + ".idx"
+
+    def load_VHD_index(self, filename, stat):
+        """Return sections stored in the index file, None if missing or stale."""
+        index_path = self.VHD_index_path(filename)
+        if not os.path.isfile(index_path):
+            return None
+        try:
+            index_file = open(index_path, "r")
+            index = json.load(index_file)
+            index_file.close()
+        except (OSError, ValueError):
+            return None
+        if index.get("version") != VHD_INDEX_VERSION or\
+           index.get("size") != stat.st_size or\
+           index.get("mtime_ns") != stat.st_mtime_ns:
+            return None
+        return index["sections"]
+
+    def save_VHD_index(self, filename, stat, sections):
+        index = {"version": VHD_INDEX_VERSION,
+                 "size": stat.st_size,
+                 "mtime_ns": stat.st_mtime_ns,
+                 "sections": sections}
+        try:
+            index_file = open(self.VHD_index_path(filename), "w")
+            json.dump(index, index_file)
+            index_file.close()
+        except OSError:
+            self.report("Could not write section index for", filename)
+
+    def find_VHD_sections(self, content):
+        sections = {"columns": None, "imagecorr": [], "data": None}
+        column_start = None
+        imagecorr_start = None
+        pos = 0
+        while pos < len(content):
+            eol = content.find(b"\n", pos)
+            eol = len(content) if eol == -1 else eol + 1
+            line = content[pos:eol]
+
+            if b"@Column Contents:" in line and column_start is None:
+                column_start = eol
+            elif b"@@END Columns" in line and sections["columns"] is None:
+                if column_start is not None:
+                    sections["columns"] = (column_start, pos)
+
+            if line.startswith(b"#"):
+                pos = eol
+                continue
+
+            if line.startswith(b"@@Data"):
+                if imagecorr_start is not None:
+                    sections["imagecorr"].append((imagecorr_start, pos))
+                    imagecorr_start = None
+                # only the end of the data block is left, search it directly
+                data_end = content.find(b"\n@@END Data.", eol - 1)
+                data_end = len(content) if data_end == -1 else data_end + 1
+                sections["data"] = (eol, data_end)
+                break
+
+            if line.startswith(b"Image Correction"):
+                if imagecorr_start is not None:
+                    sections["imagecorr"].append((imagecorr_start, pos))
+                imagecorr_start = eol
+            elif imagecorr_start is not None:
+                if self.split_image_correction_line(line) is None:
+                    sections["imagecorr"].append((imagecorr_start, pos))
+                    imagecorr_start = None
+            pos = eol
+
+        if imagecorr_start is not None:
+            sections["imagecorr"].append((imagecorr_start, pos))
+        if sections["columns"] is None and column_start is not None:
+            sections["columns"] = (column_start, len(content))
+        return sections
+
+    def split_image_correction_line(self, line):
+        split_line = line.split(b'#')[0].strip().split()
+        if len(split_line) < 2:
+            return None
+        try:
+            return float(split_line[0]), float(split_line[1])
+        except ValueError:
+            return None
+
+    def image_correction_factors(self, B_raw, B_imagecorr, imagecorr_factor):
+        """Correction factor for every field value.
+
+        Linear interpolation of the table at |B|, no correction below the
+        first table entry and the last factor above the last table entry.
+        """
+        B_abs = np.abs(B_raw)
+        corr_fac = np.ones(len(B_abs))
+        inside = np.logical_and(B_imagecorr[0] < B_abs, B_abs < B_imagecorr[-1])
+        B_inside = B_abs[inside]
+        ib = np.searchsorted(B_imagecorr, B_inside, side="right")
+        dB = B_imagecorr[ib] - B_imagecorr[ib-1]
+        corr_fac[inside] =\
+            imagecorr_factor[ib-1] *(B_imagecorr[ib] - B_inside)/dB +\
+            imagecorr_factor[ib] *(B_inside - B_imagecorr[ib-1])/dB
+        corr_fac[B_abs == B_imagecorr[0]] = imagecorr_factor[0]
+        corr_fac[B_abs >= B_imagecorr[-1]] = imagecorr_factor[-1]
+        return corr_fac
+
+    def load_image_correction_from_VHD(self, content, sections):
         B_imagecorr = []
         imagecorr_factor = []
-        read_flag = False
-        read_image_correction_flag = False
-        for line in datafile:
-            if line.startswith("#"):
-                continue
-                
-            if line.startswith('@@Data'):
-                read_flag = True
-                continue
-                
-            if line.startswith('Image Correction'):
-                read_image_correction_flag = True
-                continue
-            if read_image_correction_flag:
-                try:
-                    split_line = line.split('#')[0].strip().split()
-                    if len(split_line) < 2:
-                        read_image_correction_flag = False
-                        continue
-                    b_val = float(split_line[0])
-                    corr_val = float(split_line[1])
-                    B_imagecorr.append(b_val)
-                    imagecorr_factor.append(corr_val)
-                except:
-                    read_image_correction_flag = False
+        for start, end in sections["imagecorr"]:
+            for line in content[start:end].splitlines():
+                if line.startswith(b"#"):
                     continue
-                    
-            if read_flag:
-                if line.startswith('New Section: Section 0:'):
-                    continue
-                if line.startswith('@@END Data.'):
-                    break
-                split_line = line.split('#')[0].strip().split()
-                B.append(float(split_line[B_column]))
-                M.append(float(split_line[M_column]))
-        datafile.close()
-        
-        return np.asarray(B), np.asarray(M),\
-               np.array(B_imagecorr), np.array(imagecorr_factor)
+                b_val, corr_val = self.split_image_correction_line(line)
+                B_imagecorr.append(b_val)
+                imagecorr_factor.append(corr_val)
+        return np.array(B_imagecorr), np.array(imagecorr_factor)
 
+    def load_data_from_VHD_file(self, filename, content, sections,\
+                                B_column, M_column):
+        self.report("Loading", filename)
+        if self.imagecorr_table is None:
+            B_imagecorr, imagecorr_factor =\
+                self.load_image_correction_from_VHD(content, sections)
+        else:
+            B_imagecorr, imagecorr_factor = self.imagecorr_table
 
-    def load_columns(self, filename, search_string_B, search_string_M):
-        print("Searching for columns in", filename)
-        datafile = open(filename, 'r')
-        read_columns=False
-        list_of_columns = []
-        for line in datafile:
-            if "@Column Contents:" in line:
-                read_columns=True
-                continue
-            elif "@@END Columns" in line:
+        if sections["data"] is None:
+            B = np.array([])
+            M = np.array([])
+        else:
+            start, end = sections["data"]
+            B, M = self.convert_data_block(content[start:end], B_column, M_column)
+
+        return B, M, B_imagecorr, imagecorr_factor
+
+    def convert_data_block(self, block, B_column, M_column):
+        """Convert the selected columns of a raw @@Data block into arrays.
+
+        Section separators are cut out of the block, the remaining rows are
+        converted in one call of np.loadtxt.
+        """
+        parts = []
+        pos = 0
+        while True:
+            idx = block.find(b"New Section:", pos)
+            if idx == -1:
+                parts.append(block[pos:])
                 break
+            if idx == 0 or block[idx-1:idx] == b"\n":
+                parts.append(block[pos:idx])
+                eol = block.find(b"\n", idx)
+                pos = len(block) if eol == -1 else eol + 1
+            else:
+                parts.append(block[pos:idx+1])
+                pos = idx + 1
+        block = b"".join(parts)
+        if block.strip() == b"":
+            return np.array([]), np.array([])
+
+        data = np.loadtxt(io.BytesIO(block), usecols=(B_column, M_column),\
+                          comments="#", ndmin=2)
+        return data[:, 0], data[:, 1]
 
-            if read_columns:
+    def load_columns(self, filename, content, sections,\
+                     search_string_B, search_string_M):
+        self.report("Searching for columns in", filename)
+        list_of_columns = []
+        if sections["columns"] is not None:
+            start, end = sections["columns"]
+            for line in content[start:end].decode("utf-8", "replace").splitlines():
                 if line.startswith("Column"):
                     list_of_columns.append(line)
-        datafile.close()
 
         B_int = -1
         M_int = -1
@@ -404,20 +505,301 @@ class VSM_Extract(VSMClass):
                 M_int = int_line
         # Found both?
         if B_int == -1:
-            sys.exit(search_string_B + " not found in " + filename)
+            raise ValueError(search_string_B + " not found in " + filename)
         if M_int == -1:
-            sys.exit(search_string_M + " not found in " + filename)
+            raise ValueError(search_string_M + " not found in " + filename)
 
         B_unit = list_of_columns[B_int].strip().split("[")[-1].split("]")[0]
         M_unit = list_of_columns[M_int].strip().split("[")[-1].split("]")[0]
-        print("Selected column for B: " +str(list_of_columns[B_int].strip()))
-        print("Recognized unit:", B_unit)
-        print("Selected column for M: " +str(list_of_columns[M_int].strip()))
-        print("Recognized unit:", M_unit)
+        self.report("Selected column for B: " +str(list_of_columns[B_int].strip()))
+        self.report("Recognized unit:", B_unit)
+        self.report("Selected column for M: " +str(list_of_columns[M_int].strip()))
+        self.report("Recognized unit:", M_unit)
 
         return B_int, M_int, B_unit, M_unit
 
 
+class VSM_Extract(VSMClass, VHDReader):
+    def __init__(self, filepath=None):
+        super().__init__()
+        
+        if self.n_args < 1 and filepath is None:
+            print("Give path to file containing parameters for VSM "+\
+                  "data extraction as argument.")
+            print("Usage of vsm_dataextract.py for data extraction:")
+            self.help()
+            sys.exit()
+        if filepath is not None:
+            self.filepath = filepath
+        
+        self.log_string = ""
+        self.load_param_file()
+
+    def help(self):
+        print("python vsm_dataextract.py -extract parameter_file [..]")
+        print("Possible parameters:")
+        print("\t-noindex \t -- \t Don't use or write .idx section index files.")
+        print("\t-prec N \t -- \t Write values with N significant digits.")
+        print("\t-j N \t -- \t Extract N files in parallel (0: one per CPU).")
+        print("\t-follow \t -- \t Follow VHD files that are still being measured.")
+        print("\t-interval SEC \t -- \t Poll interval in follow mode [Default: 2]")
+        print("\t-plot \t -- \t Show live plot in follow mode.")
+        print("\t-profile \t -- \t Print wall time of each stage (not with -j).")
+        print("\t-profile_memory \t -- \t Also trace peak memory, slows down the stages.")
+        print("\t-profile_report FILE \t -- \t Also save the profile as JSON.")
+        print("")
+
+    def get_args(self):
+        if "-extract" in sys.argv:
+            self.filepath = sys.argv[sys.argv.index("-extract") + 1]
+        self.use_index = not "-noindex" in sys.argv
+        if "-j" in sys.argv:
+            self.n_jobs = int(sys.argv[sys.argv.index("-j") + 1])
+            if self.n_jobs < 1:
+                self.n_jobs = os.cpu_count()
+        else:
+            self.n_jobs = 1
+        self.follow = "-follow" in sys.argv
+        self.follow_plot = "-plot" in sys.argv
+        if "-interval" in sys.argv:
+            self.follow_interval = float(sys.argv[sys.argv.index("-interval") + 1])
+        else:
+            self.follow_interval = 2.
+
+    def load_param_file(self):
+        self.pdict = {}
+        self.samplelist = []
+        #  Start Reading parameter file
+        start_load_datapaths = False
+        pfile = open(self.filepath, "r")
+        self.log_string += "#Loaded parameter file: " + str(self.filepath) + "\n"
+        for line in pfile:
+            if line.startswith('#'):  # skip comment lines which start with #
+                continue
+            if '@start' in line:  # flag switches from parameter reading to datapaths reading
+                start_load_datapaths = True
+                continue
+            if '@end' in line:  # flag switches from parameter reading to datapaths reading
+                start_load_datapaths = False
+                continue
+            split_line = line.split('#')[0].strip().split(maxsplit=1)  # remove everything after # and split between first empty spaces/tabs
+            if len(split_line) < 2:
+                continue
+            if not start_load_datapaths:  # First load parameters, structure Name Value, then load paths
+                self.pdict[split_line[0]] = split_line[1]
+            else:
+                if not os.path.isfile(split_line[0]) and not self.follow:  # does sample file exist?
+                    sys.exit("Datapath does not exist. Entered path: " + split_line[0])
+                self.samplelist.append((split_line[0], split_line[1]))
+        pfile.close()
+
+        #  End of reading parameter file
+        try:
+            self.set_parameters(self.pdict)
+        except ValueError as error:
+            sys.exit(str(error))
+
+        if "imagecorr_file" in self.pdict:
+            self.imagecorr_table = self.load_image_correction_table(self.pdict["imagecorr_file"])
+        else:
+            self.imagecorr_table = None
+    
+        if self.follow:
+            for samplepair in self.samplelist:
+                try:
+                    self.follow_sample(samplepair)
+                except (ValueError, IOError) as error:
+                    sys.exit("Following " + samplepair[0] + " failed: " + str(error))
+            return
+
+        failed = []
+        if self.n_jobs > 1 and len(self.samplelist) > 1:
+            # Workers return their log, which is printed in order of the
+            # sample list so that output stays grouped per file
+            pool = multiprocessing.Pool(min(self.n_jobs, len(self.samplelist)))
+            results = pool.imap(self.run_extraction_captured, self.samplelist)
+            for samplepair, (log, error) in zip(self.samplelist, results):
+                sys.stdout.write(log)
+                if error is not None:
+                    failed.append(samplepair[0])
+            pool.close()
+            pool.join()
+        else:
+            for samplepair in self.samplelist:
+                if self.run_extraction(samplepair) is not None:
+                    failed.append(samplepair[0])
+
+        if len(failed) > 0:
+            sys.exit("Extraction failed for " + str(len(failed)) + " of " +\
+                     str(len(self.samplelist)) + " files:\n" + "\n".join(failed))
+
+    def run_extraction(self, samplepair):
+        """Extract one sample pair, report and return error instead of exiting."""
+        try:
+            self.extract_sample(samplepair)
+        except (Exception, SystemExit) as error:
+            print("ERROR: Extraction of " + samplepair[0] + " failed: " + str(error))
+            print("\n")
+            return str(error)
+        return None
+
+    def run_extraction_captured(self, samplepair):
+        log = io.StringIO()
+        with contextlib.redirect_stdout(log):
+            error = self.run_extraction(samplepair)
+        return log.getvalue(), error
+
+    def extract_sample(self, samplepair):
+        self.data_string = "#Loading data from file: " + samplepair[0] + "\n"
+        self.data_string += "#Save data to file: " + samplepair[1] + "\n"
+        self.data_string += "#Extraction performed at: " +  time.strftime("%c") + "\n"
+        
+        B, M, sM, M_raw, sM_raw, M_rawunit, B_imagecorr, imagecorr_factor =\
+                    self.load_data(samplepair[0]) # Load Data
+        
+        #Save data 
+        self.save_xye_file(samplepair[1], self.xye_header(M_rawunit),\
+                           [B, M, sM, M_raw, sM_raw])
+            
+        print("Saved data from "+samplepair[0]+" to: " + samplepair[1])
+        print("\n")
+
+    def follow_sample(self, samplepair):
+        """Extract a VHD file that is still being measured.
+
+        Waits for the data block to start, then polls the file and converts
+        only the rows appended since the last poll. They are appended to the
+        .xye file until @@END Data. is written or the user interrupts.
+        """
+        file_path, save_path = samplepair
+        self.data_string = "#Loading data from file: " + file_path + "\n"
+        self.data_string += "#Save data to file: " + save_path + "\n"
+        self.data_string += "#Extraction performed at: " +  time.strftime("%c") + "\n"
+        self.data_string += "#Extracted in follow mode while measuring\n"
+
+        print("Waiting for data block in", file_path)
+        while True:
+            if os.path.isfile(file_path):
+                datafile = open(file_path, 'rb')
+                content = datafile.read()
+                datafile.close()
+                sections = self.find_VHD_sections(content)
+                if sections["data"] is not None:
+                    break
+            time.sleep(self.follow_interval)
+
+        B_col, M_col, B_rawunit, M_rawunit =\
+            self.load_columns(file_path, content, sections,\
+                              self.pdict["B_column"], self.pdict["M_column"])
+        if self.imagecorr_table is None and "imagecorr_file" in self.pdict:
+            # the shared table is built once the first file has its data block
+            self.imagecorr_table = self.load_image_correction_table(self.pdict["imagecorr_file"])
+        if self.imagecorr_table is None:
+            B_imagecorr, imagecorr_factor =\
+                self.load_image_correction_from_VHD(content, sections)
+        else:
+            B_imagecorr, imagecorr_factor = self.imagecorr_table
+        pos = sections["data"][0]
+        del content
+        self.log_conversion(B_rawunit, M_rawunit, B_imagecorr, imagecorr_factor)
+        self.save_xye_file(save_path, self.xye_header(M_rawunit), [[]])
+
+        if self.follow_plot:
+            plt = pyplot()
+            plt.ion()
+            fig, ax = plt.subplots()
+            line, = ax.plot([], [], marker='.', linestyle='None')
+            ax.set_title(file_path)
+            ax.set_xlabel("$\mathit{B} \, / \, "+self.pdict["B_unit"]+"$")
+            ax.set_ylabel("$\mathit{M} \, / \, "+self.pdict["M_unit"]+"$")
+            B_plot = []
+            M_plot = []
+
+        n_points = 0
+        finished = False
+        try:
+            while not finished:
+                datafile = open(file_path, 'rb')
+                datafile.seek(pos)
+                new_content = datafile.read()
+                datafile.close()
+
+                # only complete lines are converted, the rest waits for the next poll
+                end = new_content.rfind(b"\n") + 1
+                data_end = new_content.find(b"\n@@END Data.")
+                if new_content.startswith(b"@@END Data."):
+                    end = 0
+                    finished = True
+                elif data_end != -1:
+                    end = data_end + 1
+                    finished = True
+                pos += end
+
+                B_raw, M_raw = self.convert_data_block(new_content[:end], B_col, M_col)
+                if len(B_raw) > 0:
+                    B, M, sM, sM_raw = self.convert_data(B_raw, M_raw,\
+                            B_rawunit, M_rawunit, B_imagecorr, imagecorr_factor)
+                    save_data = open(save_path, "a")
+                    save_data.write(self.format_columns([B, M, sM, M_raw, sM_raw]))
+                    save_data.close()
+                    n_points += len(B)
+                    print("Appended", len(B), "points to", save_path,\
+                          "(" + str(n_points) + " in total)")
+                    if self.follow_plot:
+                        B_plot.append(B)
+                        M_plot.append(M)
+                        line.set_data(np.concatenate(B_plot), np.concatenate(M_plot))
+                        ax.relim()
+                        ax.autoscale_view()
+                        fig.canvas.draw_idle()
+
+                if finished:
+                    break
+                if self.follow_plot:
+                    plt.pause(self.follow_interval)
+                else:
+                    time.sleep(self.follow_interval)
+        except KeyboardInterrupt:
+            print("Stopped following", file_path)
+
+        print("Saved data from "+file_path+" to: " + save_path)
+        print("\n")
+            
+    def load_image_correction_table(self, table_path):
+        """Load image correction table shared by all files of the batch.
+
+        If table_path does not exist yet, the table of the first VHD file in
+        the sample list that contains one is stored there. Files that do not
+        exist yet are skipped, in follow mode also files whose data block has
+        not started, so the table can be built once they appear.
+        """
+        if os.path.isfile(table_path):
+            table = np.loadtxt(table_path, comments="#", ndmin=2)
+            print("Loaded image correction table from " + table_path)
+            return table[:, 0], table[:, 1]
+
+        for samplepair in self.samplelist:
+            if not os.path.isfile(samplepair[0]):
+                continue
+            content, sections = self.scan_VHD_file(samplepair[0])
+            if self.follow and sections["data"] is None:
+                B_imagecorr = []
+            else:
+                B_imagecorr, imagecorr_factor =\
+                    self.load_image_correction_from_VHD(content, sections)
+            if isinstance(content, mmap.mmap):
+                content.close()
+            if len(B_imagecorr) > 0:
+                np.savetxt(table_path, np.column_stack((B_imagecorr, imagecorr_factor)),\
+                           fmt="%.17g", delimiter="\t",\
+                           header="Image correction table taken from " + samplepair[0] +\
+                                  "\nB (raw unit)\tcorrection factor")
+                print("Saved image correction table of " + samplepair[0] +\
+                      " to " + table_path)
+                return B_imagecorr, imagecorr_factor
+        print("No image correction table found to store in " + table_path)
+        return None
+
 
 if __name__ == "__main__":
     if "-extract" in sys.argv:
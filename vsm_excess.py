@@ -1,7 +1,7 @@
 import numpy as np
-import sys, os.path, lmfit
-import matplotlib.pyplot as plt
-from vsm import VSMClass
+import sys, os.path
+from vsm import VSMClass, pyplot
+from vsm_api import fit_excess
 
 class VSM_Excess(VSMClass):
     def __init__(self):
@@ -9,98 +9,56 @@ class VSM_Excess(VSMClass):
         print("Loading " + self.sample_path)
         self.load_xye_vsmfile(self.sample_path)
         
-        self.determine_excess()
+        with self.stage("fit"):
+            self.determine_excess()
         self.save_to_file_excess()
         self.plot_excess()
     
-    def linear(self, p, x):
-        return p['m'].value*x + p['n'].value
-
-    def residuum(self, p, x, y, sy):
-        return (self.linear(p, x) - y)/sy
-
     def determine_excess(self):
-        B_up_slice = np.logical_and(self.min_B<self.B, self.B<self.max_B)
-        B_down_slice = np.logical_and(-self.max_B<self.B, self.B<-self.min_B)
-        B_up = self.B[B_up_slice]
-        M_up = self.M[B_up_slice]
-        sM_up = self.sM[B_up_slice]
-          
-        p_upper_fit = lmfit.Parameters()
-        m_up_estimate = (M_up[-1] - M_up[0]) / (B_up[-1] - B_up[0])
-        p_upper_fit.add("m", m_up_estimate)
-        p_upper_fit.add("n", B_up[0])
-
-        B_down = self.B[B_down_slice]
-        M_down = self.M[B_down_slice]
-        sM_down = self.sM[B_down_slice]
-        m_down_estimate = (M_down[-1] - M_down[0]) / (B_down[-1] - B_down[0])
-        p_lower_fit = lmfit.Parameters()
-        p_lower_fit.add("m", m_down_estimate)
-        p_lower_fit.add("n", B_down[0])
-
-        res_up = lmfit.minimize(self.residuum, p_upper_fit, args=(B_up, M_up, sM_up), method='leastsq')
-        print(lmfit.fit_report(res_up))
-        res_down = lmfit.minimize(self.residuum, p_lower_fit, args=(B_down, M_down, sM_down), method='leastsq')
-        print(lmfit.fit_report(res_down))
-
-        p_upper_fit = res_up.params
-        p_lower_fit = res_down.params
-
-        self.mup = p_upper_fit["m"].value
-        self.nup = p_upper_fit["n"].value
-        self.mlow = p_lower_fit["m"].value
-        self.nlow = p_lower_fit["n"].value
-        
-        self.smup = p_upper_fit["m"].stderr
-        self.snup = p_upper_fit["n"].stderr
-        self.smlow = p_lower_fit["m"].stderr
-        self.snlow = p_lower_fit["n"].stderr
-
-        self.sm = 1./self.smup**2 + 1./self.smlow**2
-        self.m = (self.mup/self.smup**2 + self.mlow/self.smlow**2) / self.sm
-        self.sm = np.sqrt(1./self.sm)
-        
-        self.sn = 1./self.snup**2 + 1./self.snlow**2
-        self.n = (self.nup/self.snup**2 - self.nlow/self.snlow**2) / self.sn
-        self.sn = np.sqrt(1./self.sn)
-
-        self.M_corr = self.M - self.m*self.B
-        self.sM_corr = self.sM
+        fit = fit_excess(self.B, self.M, self.sM, self.min_B, self.max_B)
+        for name in ["mup", "nup", "smup", "snup", "mlow", "nlow", "smlow",\
+                     "snlow", "m", "sm", "n", "sn", "M_corr", "sM_corr"]:
+            setattr(self, name, fit[name])
+        self.print_fit("Fit of upper branch", self.mup, self.smup,\
+                       self.nup, self.snup, fit["redchi_up"], fit["N_up"])
+        self.print_fit("Fit of lower branch", self.mlow, self.smlow,\
+                       self.nlow, self.snlow, fit["redchi_low"], fit["N_low"])
+
+    def print_fit(self, title, m, sm, n, sn, redchi, ndata):
+        print(title + ":")
+        print("\tdata points  = " + str(ndata))
+        print("\treduced chi2 = " + str(redchi))
+        print("\tm = " + str(m) + " +/- " + str(sm))
+        print("\tn = " + str(n) + " +/- " + str(sn))
 
     def print_log(self, entry):
         self.header += '#' + entry + '\n'
         print(entry)
 
     def save_to_file_excess(self):
-        save_data = open(self.save_to, "w")
-        save_data.write(self.header)
-        save_data.write("#Excess corrected file: " +self.sample_path + "\n")
-        save_data.write("#Fitted slope: " + str(self.m) + ' +\- ' + str(self.sm) + "\n")
-        save_data.write("#Fitted shift: " + str(self.n) + ' +\- ' + str(self.sn) + "\n")
+        header = self.header
+        header += "#Excess corrected file: " +self.sample_path + "\n"
+        header += "#Fitted slope: " + str(self.m) + ' +\- ' + str(self.sm) + "\n"
+        header += "#Fitted shift: " + str(self.n) + ' +\- ' + str(self.sn) + "\n"
         
-        save_data.write("#B / "+self.Bunit+\
-                        "\tM_corr / "+self.Munit+\
-                        "\tsM_corr / "+ self.Munit+\
-                        "\tM_loaded / "+self.Munit+\
-                        "\tsM_loaded / "+ self.Munit+\
-                        "\tM_raw / "+self.Mrawunit+\
-                        "\tsM_raw / "+ self.Mrawunit+"\n")
-        for i, bval in enumerate(self.B):
-            save_data.write(str(bval)+"\t"+\
-                            str(self.M_corr[i])+"\t"+\
-                            str(self.sM_corr[i])+"\t"+\
-                            str(self.M[i])+"\t"+\
-                            str(self.sM[i])+"\t"+\
-                            str(self.Mraw[i])+"\t"+\
-                            str(self.sMraw[i])+"\n")
-        save_data.close()
+        header += "#B / "+self.Bunit+\
+                  "\tM_corr / "+self.Munit+\
+                  "\tsM_corr / "+ self.Munit+\
+                  "\tM_loaded / "+self.Munit+\
+                  "\tsM_loaded / "+ self.Munit+\
+                  "\tM_raw / "+self.Mrawunit+\
+                  "\tsM_raw / "+ self.Mrawunit+"\n"
+        self.save_xye_file(self.save_to, header,\
+                           [self.B, self.M_corr, self.sM_corr, self.M, self.sM,\
+                            self.Mraw, self.sMraw])
 
     def plot_excess(self):
         if self.Munit == "kAm-1":
             Munit = "kAm^{-1}"
         else:
             Munit = self.Munit
+        self.profiler.start_stage("plot")
+        plt = pyplot()
         fig, ax = plt.subplots()
         ax.axhline(0, color='black')
         ax.axvline(0, color='black')
@@ -118,13 +76,23 @@ class VSM_Excess(VSMClass):
         plt.legend(loc='best', fontsize=8).draw_frame(True)
 
         fig.savefig(self.plot_path)
-        plt.show()
+        self.profiler.end_stage()
+        if self.show_plots:
+            plt.show()
+        else:
+            plt.close(fig)
         
     def help(self):
         print("python vsm_excess.py samplefile Min_B Max_B [saveto]")
         print("\nFit data between Min_B, Max_B linearly and substract mean slope from data. ")
         print("Possible Parameters:")
         print("-saveto SAVEPATH\t -- \t Save data to SAVEPATH.")
+        print("-noshow \t -- \t Only save the plot, no window (also --no-show).")
+        print("-cache \t -- \t Keep binary copies of loaded .xye files for faster reloading.")
+        print("-prec N \t -- \t Write values with N significant digits.")
+        print("-profile \t -- \t Print wall time of each stage.")
+        print("-profile_memory \t -- \t Also trace peak memory, slows down the stages.")
+        print("-profile_report FILE \t -- \t Also save the profile as JSON.")
 
         
     def get_args(self):
@@ -0,0 +1,264 @@
+import os, sys, importlib, functools, collections, hashlib
+import numpy as np
+
+kB = 1.38064852e-23 # J/K
+muB = 9.274009994e-24 # J/T
+muB_by_kB = 0.6717140430498562 # K/T
+
+# NumPy implementation of the models module of fortran/models.f90 with the
+# same call signatures. It is used if the Fortran extension is not built.
+
+def langevin(B, p, Np=None):
+    """Langevin: Spherical Homogenously Magnetized Particle with large moment"""
+    Ms = p[0]
+    xi = p[1]
+
+    x = xi*np.asarray(B, dtype=float)
+    x2 = x*x
+    # series expansion for small x, avoids cancellation of 1/tanh(x) - 1/x
+    series = x*(1./3. + x2*(-1./45. + x2*(2./945. +\
+               x2*(-1./4725. + x2*2./93555.))))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        direct = 1./np.tanh(x) - 1./x
+    L = Ms*np.where(np.abs(x) < 0.1, series, direct)
+    if L.ndim == 0:
+        return float(L)
+    return L
+
+def langevin_derivative(x):
+    """dL/dx of the Langevin function L(x) = 1/tanh(x) - 1/x"""
+    x = np.asarray(x, dtype=float)
+    x2 = x*x
+    series = 1./3. + x2*(-1./15. + x2*(2./189. +\
+               x2*(-1./675. + x2*2./10395.)))
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        direct = 1./x2 - 1./np.sinh(x)**2
+    dL = np.where(np.abs(x) < 0.1, series, direct)
+    if dL.ndim == 0:
+        return float(dL)
+    return dL
+
+def langevin_mu(B, p, Np=None):
+    Ms = p[0]
+    mu = p[1]
+    T = p[2]
+
+    xi = mu/T*muB_by_kB
+    return langevin(B, (Ms, xi))
+
+@functools.lru_cache(maxsize=16)
+def lognormal_nodes(nnodes):
+    """Gauss-Hermite nodes z and weights w with sum(w*f(z)) = <f(z)> for
+    standard normal distributed z."""
+    nodes, weights = np.polynomial.hermite.hermgauss(nnodes)
+    return np.sqrt(2.)*nodes, weights/np.sqrt(np.pi)
+
+def magnetization_mu(B, Ms, mu, T, sig_mu, NB=None, nnodes=64, chunksize=4096):
+    """Langevin magnetization of particles with lognormal distributed moment.
+
+    The Fortran version integrates the distribution adaptively, here it is
+    magnetization_mu_nodes with nnodes = 64 nodes.
+    """
+    return magnetization_mu_nodes(B, Ms, mu, T, sig_mu, nnodes,\
+                                  chunksize=chunksize)[0]
+
+def magnetization_mu_nodes(B, Ms, mu, T, sig_mu, nnodes=32, n_check=0, NB=None,\
+                           chunksize=4096):
+    """Same as magnetization_mu, but the distribution is integrated with
+    nnodes fixed Gauss-Hermite nodes in log(mu), evaluated for chunks of B
+    values at once. Returns Magnetization and error_estimate, the largest
+    deviation at n_check fields spread over B from the integration with
+    4*nnodes nodes (-1 if n_check = 0).
+    """
+    B = np.atleast_1d(np.asarray(B, dtype=float))
+    if sig_mu <= 0:
+        Magnetization = langevin_mu(B, (Ms, mu, T))
+    else:
+        nodes, weights = lognormal_nodes(nnodes)
+        xi = mu*np.exp(sig_mu*nodes)/T*muB_by_kB
+        Magnetization = np.empty(len(B))
+        for i in range(0, len(B), chunksize):
+            kernel = langevin(B[i:i+chunksize, None], (1., xi[None, :]))
+            Magnetization[i:i+chunksize] = kernel @ weights
+        Magnetization = Ms*Magnetization
+
+    error_estimate = -1.
+    n_check = min(n_check, len(B))
+    if n_check > 0:
+        icheck = np.linspace(0, len(B) - 1, n_check).astype(int)
+        reference = magnetization_mu_nodes(B[icheck], Ms, mu, T, sig_mu,\
+                                           4*nnodes)[0]
+        error_estimate = float(np.max(np.abs(Magnetization[icheck] - reference)))
+    return Magnetization, error_estimate
+
+def magnetization_mu_jacobian(B, Ms, mu, T, sig_mu, nnodes=32, NB=None):
+    """magnetization_mu_nodes together with the derivatives of M with respect
+    to Ms, mu and sig_mu (columns of Jacobian), on the same nodes.
+    """
+    B = np.atleast_1d(np.asarray(B, dtype=float))
+    if sig_mu > 0:
+        nodes, weights = lognormal_nodes(nnodes)
+    else:
+        # dM/dsig_mu vanishes at sig_mu = 0
+        nodes, weights = np.zeros(1), np.ones(1)
+    xi = mu*np.exp(sig_mu*nodes)/T*muB_by_kB
+
+    x = B[:, None]*xi[None, :]
+    dkernel = x*langevin_derivative(x)
+    Jacobian = np.empty((len(B), 3))
+    Jacobian[:, 0] = langevin(x, (1., 1.)) @ weights
+    Jacobian[:, 1] = Ms/mu*(dkernel @ weights)
+    Jacobian[:, 2] = Ms*(dkernel @ (weights*nodes))
+    return Ms*Jacobian[:, 0], Jacobian
+
+# Thread settings of the Fortran backend. The NumPy backend is serial, the
+# values are only stored so both backends can be configured the same way.
+n_threads = 0
+serial_threshold = 16
+
+def set_num_threads(threads):
+    global n_threads
+    n_threads = max(int(threads), 0)
+
+def set_serial_threshold(threshold):
+    global serial_threshold
+    serial_threshold = max(int(threshold), 0)
+
+def get_parallel_settings():
+    return n_threads, 1, serial_threshold
+
+def magnetization_mu_grid(B, params, nnodes=32, NB=None, Ngrid=None,
+                          chunksize=2**22):
+    """magnetization_mu_nodes for many parameter sets at once. Each row of
+    params is (Ms, mu, T, sig_mu), row i of the result is M(B) for params[i].
+    """
+    B = np.atleast_1d(np.asarray(B, dtype=float))
+    params = np.atleast_2d(np.asarray(params, dtype=float))
+    Ms, mu, T, sig_mu = params.T
+    nodes, weights = lognormal_nodes(nnodes)
+    xi = mu[:, None]*np.exp(sig_mu[:, None]*nodes[None, :])/T[:, None]*\
+         muB_by_kB
+
+    Magnetization = np.empty((len(params), len(B)))
+    step = max(1, chunksize//max(len(B)*nnodes, 1))
+    for i in range(0, len(params), step):
+        x = xi[i:i+step, None, :]*B[None, :, None]
+        Magnetization[i:i+step] = langevin(x, (1., 1.)) @ weights
+    # without distribution the node average is replaced by L(xi*B)
+    single = sig_mu <= 0
+    if np.any(single):
+        Magnetization[single] = langevin(B[None, :]*(mu/T*\
+                                    muB_by_kB)[single, None], (1., 1.))
+    return Ms[:, None]*Magnetization
+
+def langevin_fit_functions(B, M, T, sM=None, nnodes=32):
+    """Residual and analytic Jacobian for a lmfit fit of
+    M(B) = magnetization_mu(B, Ms, mu, T, sig_mu) + chi*B.
+
+    params need Ms, mu and sig_mu, chi is optional. Usage:
+        residual, jacobian = langevin_fit_functions(B, M, T, sM)
+        lmfit.minimize(residual, params, Dfun=jacobian, col_deriv=1)
+    Model and derivatives come from one quadrature pass, which is shared by
+    residual and jacobian for the same parameter values.
+    """
+    B = np.asarray(B, dtype=float)
+    M = np.asarray(M, dtype=float)
+    weight = 1. if sM is None else 1./np.asarray(sM, dtype=float)
+    columns = {"Ms": 0, "mu": 1, "sig_mu": 2}
+    last = {}
+
+    def evaluate(params):
+        key = tuple(params[name].value for name in ("Ms", "mu", "sig_mu"))
+        if last.get("key") != key:
+            last["key"] = key
+            last["value"] = models.magnetization_mu_jacobian(B, *(key[:2] +\
+                                (T, key[2], nnodes)))
+        return last["value"]
+
+    def residual(params):
+        Magnetization, Jacobian = evaluate(params)
+        if "chi" in params:
+            Magnetization = Magnetization + params["chi"].value*B
+        return (Magnetization - M)*weight
+
+    def jacobian(params):
+        Magnetization, Jacobian = evaluate(params)
+        rows = []
+        for name, par in params.items():
+            if not par.vary:
+                continue
+            if name == "chi":
+                rows.append(B)
+            elif name in columns:
+                rows.append(Jacobian[:, columns[name]])
+            else:
+                raise ValueError("No derivative for parameter " + name)
+        return np.array(rows)*weight
+
+    return residual, jacobian
+
+class MagnetizationCache(object):
+    """LRU cache of magnetization_mu curves for repeated evaluation, e.g. in
+    a slider GUI. M scales linearly with Ms, so the curve is stored for Ms = 1
+    and keyed on (mu, sig_mu, T, B). Changes of Ms or chi need no new
+    integration.
+    """
+    def __init__(self, maxsize=64, function=None):
+        self.maxsize = maxsize
+        self.function = function
+        self.curves = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_curve(self, B, mu, T, sig_mu):
+        B = np.ascontiguousarray(B, dtype=float)
+        key = (float(mu), float(sig_mu), float(T), B.shape,\
+               hashlib.sha1(B.tobytes()).hexdigest())
+        curve = self.curves.get(key)
+        if curve is not None:
+            self.hits += 1
+            self.curves.move_to_end(key)
+            return curve
+
+        self.misses += 1
+        function = self.function or models.magnetization_mu
+        curve = function(B, 1., float(mu), float(T), float(sig_mu))
+        self.curves[key] = curve
+        if len(self.curves) > self.maxsize:
+            self.curves.popitem(last=False)
+        return curve
+
+    def magnetization(self, B, Ms, mu, T, sig_mu, chi=0.):
+        """magnetization_mu(B, Ms, mu, T, sig_mu) + chi*B"""
+        M = float(Ms)*self.get_curve(B, mu, T, sig_mu)
+        if chi:
+            M = M + float(chi)*np.asarray(B, dtype=float)
+        return M
+
+    def clear(self):
+        self.curves.clear()
+        self.hits = 0
+        self.misses = 0
+
+def load_models(backend=None):
+    """Return models module and name of the backend.
+
+    backend can be "fortran" or "numpy". If not given, the compiled Fortran
+    extension (see fortran/compile.sh) is used if it can be imported and the
+    NumPy implementation of this module otherwise.
+    """
+    if backend is None or backend == "fortran":
+        for module_name in ("VSMFortran", "VSM.VSMFortran"):
+            try:
+                return importlib.import_module(module_name).models, "fortran"
+            except ImportError:
+                continue
+        if backend == "fortran":
+            raise ImportError("Fortran extension VSMFortran not found. "+\
+                              "Build it with fortran/compile.sh.")
+    elif backend != "numpy":
+        raise ValueError("Unknown backend: " + str(backend))
+    return sys.modules[__name__], "numpy"
+
+# Backend can be forced with environment variable VSM_BACKEND=numpy/fortran
+models, backend = load_models(os.environ.get("VSM_BACKEND"))
@@ -0,0 +1,301 @@
+import numpy as np
+import sys, os, os.path, json, hashlib
+from vsm import VSMClass, pyplot
+import vsm_api as api
+
+PIPELINE_CACHE_VERSION = 1
+
+class VSM_Pipeline(VSMClass):
+    """Run extraction, substraction, excess correction and rescaling for
+    all samples of a pipeline file.
+
+    The pipeline file is an extraction parameter file whose data list names
+    the stages of every sample after the save path. Results of every stage
+    are cached under a hash of the input file contents and all parameters of
+    the stage and the stages before, so only changed stages are run again.
+    """
+    def __init__(self):
+        super().__init__()
+        self.file_hashes = {}
+        self.load_pipeline_file()
+        if self.cache_dir is None:
+            self.cache_dir = self.pdict.get("cache_dir",\
+                os.path.join(os.path.dirname(self.filepath), ".vsm_cache"))
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self.load_output_keys()
+
+        failed = []
+        for sample in self.samples:
+            try:
+                self.run_sample(sample)
+            except Exception as error:
+                print("ERROR: Pipeline for " + sample["vhd_path"] + " failed: " + str(error))
+                failed.append(sample["vhd_path"])
+            print("\n")
+        self.save_output_keys()
+
+        if len(failed) > 0:
+            sys.exit("Pipeline failed for " + str(len(failed)) + " of " +\
+                     str(len(self.samples)) + " samples:\n" + "\n".join(failed))
+
+    def help(self):
+        print("python vsm_pipeline.py pipeline_file [..]")
+        print("\nThe pipeline file is an extraction parameter file (see vsm_dataextract.py) "+\
+              "with the stages of each sample behind the save path:")
+        print("\n@start data list")
+        print("sample.VHD\tsample.xye\tsub=0.02 sig=0.001 excess=1,1.8 rescale=2.5,kAm-1 plot")
+        print("sample2.VHD\tsample2.xye\tsub=background.xye sf=0.5")
+        print("@end data list")
+        print("\nStages, run in this order:")
+        print("sub=SLOPE or sub=FILE \t -- \t Substract slope or .xye background, with sf=SF and sig=SIGMA")
+        print("excess=MINB,MAXB \t -- \t Excess correction between MINB and MAXB")
+        print("rescale=FACTOR,UNIT \t -- \t Rescale to UNIT, with rsig=SIGMA")
+        print("plot \t -- \t Save plot of the result next to the save path.")
+        print("\nPossible parameters:")
+        print("-force \t -- \t Run all stages, ignore cached results.")
+        print("-cachedir DIR \t -- \t Cache directory [Default: .vsm_cache next to pipeline file, "+\
+              "or cache_dir parameter]")
+        print("-prec N \t -- \t Write values with N significant digits.")
+
+    def get_args(self):
+        if self.n_args < 1 or sys.argv[1].startswith("-"):
+            print("Give path to pipeline file as argument.")
+            self.help()
+            sys.exit()
+        self.filepath = sys.argv[1]
+        self.force = "-force" in sys.argv
+        if "-cachedir" in sys.argv:
+            self.cache_dir = sys.argv[sys.argv.index("-cachedir") + 1]
+        else:
+            self.cache_dir = None
+
+    def load_pipeline_file(self):
+        self.pdict = {}
+        self.samples = []
+        start_load_datapaths = False
+        pfile = open(self.filepath, "r")
+        for line in pfile:
+            if line.startswith('#'):
+                continue
+            if '@start' in line:
+                start_load_datapaths = True
+                continue
+            if '@end' in line:
+                start_load_datapaths = False
+                continue
+            if not start_load_datapaths:
+                split_line = line.split('#')[0].strip().split(maxsplit=1)
+                if len(split_line) == 2:
+                    self.pdict[split_line[0]] = split_line[1]
+            else:
+                split_line = line.split('#')[0].split()
+                if len(split_line) < 2:
+                    continue
+                self.samples.append(self.parse_stages(split_line[0], split_line[1],\
+                                                      split_line[2:]))
+        pfile.close()
+
+        for pname in ["B_column", "M_column", "B_unit", "M_unit", "noise_level"]:
+            if not pname in self.pdict:
+                sys.exit("Define parameter " + pname + " in " + self.filepath)
+
+    def parse_stages(self, vhd_path, save_to, tokens):
+        sample = {"vhd_path": vhd_path, "save_to": save_to, "stages": [],\
+                  "plot": False}
+        options = {}
+        for token in tokens:
+            if token == "plot":
+                sample["plot"] = True
+            elif "=" in token:
+                name, value = token.split("=", 1)
+                options[name] = value
+            else:
+                sys.exit("Unknown stage " + token + " for " + vhd_path)
+        unknown = set(options) - {"sub", "sf", "sig", "excess", "rescale", "rsig"}
+        if len(unknown) > 0:
+            sys.exit("Unknown stages " + ", ".join(sorted(unknown)) + " for " + vhd_path)
+
+        try:
+            if "sub" in options:
+                sf = float(options.get("sf", 1.))
+                try:
+                    sample["stages"].append(("substract", {"slope": float(options["sub"]),\
+                        "sf": sf, "sigma_slope": float(options.get("sig", 0.))}))
+                except ValueError:
+                    sample["stages"].append(("substract",\
+                        {"background": options["sub"], "sf": sf}))
+            if "excess" in options:
+                min_B, max_B = options["excess"].split(",")
+                sample["stages"].append(("excess",\
+                    {"min_B": float(min_B), "max_B": float(max_B)}))
+            if "rescale" in options:
+                scalefactor, Munit = options["rescale"].split(",")
+                sample["stages"].append(("rescale", {"scalefactor": float(scalefactor),\
+                    "Munit": Munit, "sigma_scale": float(options.get("rsig", 0.))}))
+        except ValueError:
+            sys.exit("Could not read stage parameters for " + vhd_path)
+        return sample
+
+    def extract_parameters(self, sample):
+        parameters = {"vhd_path": sample["vhd_path"]}
+        for pname in ["B_column", "M_column", "B_unit", "M_unit", "noise_level", "V"]:
+            if pname in self.pdict:
+                parameters[pname] = self.pdict[pname]
+        if "imagecorr_file" in self.pdict:
+            parameters["imagecorr_source"] = self.pdict["imagecorr_file"]
+        return parameters
+
+    def file_hash(self, filepath):
+        """sha256 of the content of filepath, computed once per run."""
+        if not filepath in self.file_hashes:
+            hasher = hashlib.sha256()
+            hashfile = open(filepath, "rb")
+            for block in iter(lambda: hashfile.read(2**20), b""):
+                hasher.update(block)
+            hashfile.close()
+            self.file_hashes[filepath] = hasher.hexdigest()
+        return self.file_hashes[filepath]
+
+    def stage_key(self, previous_key, stage, parameters, files):
+        description = [PIPELINE_CACHE_VERSION, previous_key, stage, parameters,\
+                       [self.file_hash(filepath) for filepath in files]]
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def stage_files(self, sample, stage, parameters):
+        """Input files of a stage, their content is part of the cache key."""
+        if stage == "extract":
+            files = [sample["vhd_path"]]
+            if "imagecorr_source" in parameters:
+                files.append(parameters["imagecorr_source"])
+            return files
+        if stage == "substract" and "background" in parameters:
+            return [parameters["background"]]
+        return []
+
+    def run_sample(self, sample):
+        print("Pipeline for " + sample["vhd_path"])
+        stages = [("extract", self.extract_parameters(sample))] + sample["stages"]
+        keys = []
+        key = None
+        for stage, parameters in stages:
+            key = self.stage_key(key, stage, parameters,\
+                                 self.stage_files(sample, stage, parameters))
+            keys.append(key)
+
+        # continue after the last stage with a cached result
+        start = len(stages)
+        while start > 0 and (self.force or not os.path.isfile(self.cache_path(keys[start-1]))):
+            start -= 1
+        data = None
+        if start > 0:
+            for stage, parameters in stages[:start]:
+                print("\t" + stage + ": cached")
+            if start < len(stages):
+                data = self.load_cached(keys[start-1])
+        for istage in range(start, len(stages)):
+            stage, parameters = stages[istage]
+            print("\t" + stage + ": running")
+            with self.stage(stage):
+                data = self.run_stage(sample, stage, parameters, data)
+            self.save_cached(keys[istage], data)
+
+        final_key = keys[-1]
+        outputs = [(sample["save_to"], self.save_result)]
+        if sample["plot"]:
+            outputs.append((sample["save_to"].rsplit(".", 1)[0] + ".png", self.plot_result))
+        for output_path, write_output in outputs:
+            if not self.force and os.path.isfile(output_path) and\
+               self.output_keys.get(os.path.abspath(output_path)) == final_key:
+                print("\t" + output_path + " is up to date")
+                continue
+            if data is None:
+                data = self.load_cached(final_key)
+            write_output(output_path, data, sample)
+            self.output_keys[os.path.abspath(output_path)] = final_key
+
+    def run_stage(self, sample, stage, parameters, data):
+        if stage == "extract":
+            imagecorr_table = None
+            if "imagecorr_source" in parameters:
+                table = np.loadtxt(parameters["imagecorr_source"], comments="#", ndmin=2)
+                imagecorr_table = (table[:, 0], table[:, 1])
+            return api.extract(imagecorr_table=imagecorr_table, **parameters)
+        elif stage == "substract":
+            if "background" in parameters:
+                return api.substract_background(data, api.load(parameters["background"]),\
+                                                parameters["sf"])
+            return api.substract_slope(data, parameters["slope"], parameters["sf"],\
+                                       parameters["sigma_slope"])
+        elif stage == "excess":
+            return api.correct_excess(data, parameters["min_B"], parameters["max_B"])
+        elif stage == "rescale":
+            return api.rescale(data, parameters["scalefactor"], parameters["Munit"],\
+                               parameters["sigma_scale"])
+        raise ValueError("Unknown stage: " + stage)
+
+    def cache_path(self, key):
+        return os.path.join(self.cache_dir, key + ".npz")
+
+    def save_cached(self, key, data):
+        info = {"header": data.header, "Bunit": data.Bunit, "Munit": data.Munit,\
+                "Mrawunit": data.Mrawunit, "provenance": data.provenance}
+        tmp_path = self.cache_path(key) + ".tmp"
+        cache_file = open(tmp_path, "wb")
+        np.savez(cache_file, data=np.array([data.B, data.M, data.sM, data.Mraw, data.sMraw]),\
+                 info=np.array(json.dumps(info)))
+        cache_file.close()
+        os.replace(tmp_path, self.cache_path(key))
+
+    def load_cached(self, key):
+        cache = np.load(self.cache_path(key), allow_pickle=False)
+        info = json.loads(str(cache["info"]))
+        B, M, sM, Mraw, sMraw = cache["data"]
+        return api.VSMData(B, M, sM, Mraw, sMraw, info["header"], info["Bunit"],\
+                           info["Munit"], info["Mrawunit"], info["provenance"])
+
+    def output_keys_path(self):
+        return os.path.join(self.cache_dir, "outputs.json")
+
+    def load_output_keys(self):
+        """Cache keys of the results last written to the output files."""
+        self.output_keys = {}
+        if os.path.isfile(self.output_keys_path()):
+            try:
+                keys_file = open(self.output_keys_path(), "r")
+                self.output_keys = json.load(keys_file)
+                keys_file.close()
+            except ValueError:
+                self.output_keys = {}
+
+    def save_output_keys(self):
+        keys_file = open(self.output_keys_path(), "w")
+        json.dump(self.output_keys, keys_file, indent=1)
+        keys_file.close()
+
+    def save_result(self, save_path, data, sample):
+        with self.stage("write"):
+            header = data.header + "#Pipeline result for " + sample["vhd_path"] + "\n"
+            self.save_xye_file(save_path, header + data.column_header(),\
+                               [data.B, data.M, data.sM, data.Mraw, data.sMraw])
+        print("\tSaved data to " + save_path)
+
+    def plot_result(self, plot_path, data, sample):
+        # plots of the pipeline are only saved
+        plt = pyplot(show=False)
+        with self.stage("plot"):
+            fig, ax = plt.subplots()
+            ax.axhline(0, color='black')
+            ax.axvline(0, color='black')
+            ax.errorbar(data.B, data.M, data.sM,\
+                        label=os.path.splitext(os.path.basename(sample["save_to"]))[0])
+            ax.set_xlabel("$\mathit{B} \, / \, " + data.Bunit + "$")
+            ax.set_ylabel("$\mathit{M} \, / \, " + data.Munit + "$")
+            ax.set_xlim([min(data.B), max(data.B)])
+            plt.legend(loc='best', fontsize=8).draw_frame(True)
+            fig.savefig(plot_path)
+            plt.close(fig)
+        print("\tSaved plot to " + plot_path)
+
+if __name__ == "__main__":
+    VSM_Pipeline()
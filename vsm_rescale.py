@@ -1,7 +1,7 @@
 import numpy as np
 import sys, os.path
-import matplotlib.pyplot as plt
-from vsm import VSMClass
+from vsm import VSMClass, pyplot
+from vsm_api import rescale_magnetization
 
 class VSM_Rescale(VSMClass):
     def __init__(self):
@@ -9,39 +9,31 @@ class VSM_Rescale(VSMClass):
         print("Loading " + self.sample_path)
         self.load_xye_vsmfile(self.sample_path)
         
-        self.rescale()
+        with self.stage("rescale"):
+            self.rescale()
         self.save_to_file_rescale()
         self.plot_rescaling()
         
     def rescale(self):
-        self.M_res = self.M/self.scalefactor
-        self.sM_res = self.sM/self.scalefactor
-        self.sM_res = self.M_res*np.sqrt((self.sM_res/self.M_res)**2 +\
-                       (self.sigma_scale/self.scalefactor)**2)
+        self.M_res, self.sM_res = rescale_magnetization(self.M, self.sM,\
+                                      self.scalefactor, self.sigma_scale)
                        
     def save_to_file_rescale(self):
-        save_data = open(self.save_to, "w")
-        save_data.write(self.header)
-        save_data.write("#Rescaled file: " +self.sample_path+"\n")
-        save_data.write("#Rescale Factor: " + str(self.scalefactor) + "\n")
-        save_data.write("#Sigma Scalefactor: " + str(self.sigma_scale) + "\n")
+        header = self.header
+        header += "#Rescaled file: " +self.sample_path+"\n"
+        header += "#Rescale Factor: " + str(self.scalefactor) + "\n"
+        header += "#Sigma Scalefactor: " + str(self.sigma_scale) + "\n"
         
-        save_data.write("#B / "+self.Bunit+\
-                        "\tM_scaled / "+self.Mnewunit+\
-                        "\tsM_scaled / "+ self.Mnewunit+\
-                        "\tM_prescaling / "+self.Munit+\
-                        "\tsM_prescaling / "+ self.Munit+\
-                        "\tM_raw / "+self.Mrawunit+\
-                        "\tsM_raw / "+ self.Mrawunit+"\n")
-        for i, bval in enumerate(self.B):
-            save_data.write(str(bval)+"\t"+\
-                            str(self.M_res[i])+"\t"+\
-                            str(self.sM_res[i])+"\t"+\
-                            str(self.M[i])+"\t"+\
-                            str(self.sM[i])+"\t"+\
-                            str(self.Mraw[i])+"\t"+\
-                            str(self.sMraw[i])+"\n")
-        save_data.close()
+        header += "#B / "+self.Bunit+\
+                  "\tM_scaled / "+self.Mnewunit+\
+                  "\tsM_scaled / "+ self.Mnewunit+\
+                  "\tM_prescaling / "+self.Munit+\
+                  "\tsM_prescaling / "+ self.Munit+\
+                  "\tM_raw / "+self.Mrawunit+\
+                  "\tsM_raw / "+ self.Mrawunit+"\n"
+        self.save_xye_file(self.save_to, header,\
+                           [self.B, self.M_res, self.sM_res, self.M, self.sM,\
+                            self.Mraw, self.sMraw])
 
     def plot_rescaling(self):
         if self.Mnewunit == "kAm-1":
@@ -51,6 +43,8 @@ class VSM_Rescale(VSMClass):
         else:
             Munit = self.Mnewunit
             
+        self.profiler.start_stage("plot")
+        plt = pyplot()
         fig, ax = plt.subplots()
         ax.axhline(0, color='black')
         ax.axvline(0, color='black')
@@ -67,13 +61,23 @@ class VSM_Rescale(VSMClass):
         plt.legend(loc='best', fontsize=8).draw_frame(True)
 
         fig.savefig(self.plot_path)
-        plt.show()
+        self.profiler.end_stage()
+        if self.show_plots:
+            plt.show()
+        else:
+            plt.close(fig)
         
     def help(self):
         print("python vsm_rescale.py samplefile SCALEFACTOR NEWUNIT [..]")
         print("Possible Parameters:")
         print("-sig SIGMA\t -- \t Increase error by systematic error.")
         print("-saveto SAVEPATH\t -- \t Save data to SAVEPATH.")
+        print("-noshow \t -- \t Only save the plot, no window (also --no-show).")
+        print("-cache \t -- \t Keep binary copies of loaded .xye files for faster reloading.")
+        print("-prec N \t -- \t Write values with N significant digits.")
+        print("-profile \t -- \t Print wall time of each stage.")
+        print("-profile_memory \t -- \t Also trace peak memory, slows down the stages.")
+        print("-profile_report FILE \t -- \t Also save the profile as JSON.")
         print("-help \t -- \t Print help")
         
     def get_args(self):
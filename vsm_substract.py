@@ -1,11 +1,15 @@
 import numpy as np
-import sys, os.path
-import matplotlib.pyplot as plt
-from vsm import VSMClass
+import sys, os.path, glob
+from vsm import VSMClass, pyplot, select_plot_backend, find_sweep_branches,\
+                sweep_tolerance
+from vsm_api import substract_linear_background, nearest_point_substraction
 
 class VSM_Substract(VSMClass):
     def __init__(self):
         super().__init__()
+        if self.batch_mode:
+            self.substract_batch()
+            return
         print("Loading " + self.sample_path)
         self.load_xye_vsmfile(self.sample_path)
         self.substract_nearest_neighbor = False
@@ -20,9 +24,52 @@ class VSM_Substract(VSMClass):
             self.save_to_file_linear_substraction()
             self.plot_substraction_linear()
         
+    def substract_batch(self):
+        """Substract one background (slope or file) from many samples.
+
+        The background is loaded and sorted once, plots are only saved.
+        """
+        self.show_plots = False
+        if self.plot_batch:
+            select_plot_backend(show=False)
+        if self.substract_pbp:
+            print("Loading background " + self.bg_path)
+            self.load_bg()
+            self.idx_sorted_bg = np.argsort(self.B_bg)
+        
+        failed = []
+        for sample_path in self.sample_list:
+            self.set_sample_path(sample_path)
+            self.sf = self.sf_table.get(sample_path,\
+                      self.sf_table.get(os.path.basename(sample_path), self.default_sf))
+            print("Loading " + self.sample_path + " (scale factor " + str(self.sf) + ")")
+            try:
+                self.load_xye_vsmfile(self.sample_path)
+                self.substract_nearest_neighbor = False
+                if self.substract_pbp:
+                    self.substract_ptbypt()
+                    self.save_to_file_ptbypt()
+                    if self.plot_batch:
+                        self.plot_substraction_ptbypt()
+                else:
+                    self.substract_linear()
+                    self.save_to_file_linear_substraction()
+                    if self.plot_batch:
+                        self.plot_substraction_linear()
+            except (Exception, SystemExit) as error:
+                print("ERROR: Substraction for " + sample_path + " failed: " + str(error))
+                failed.append(sample_path)
+                continue
+            print("Saved data to " + self.save_to)
+
+        if len(failed) > 0:
+            sys.exit("Substraction failed for " + str(len(failed)) + " of " +\
+                     str(len(self.sample_list)) + " files:\n" + "\n".join(failed))
+
     def substract_linear(self):
-        self.M_sub = self.M - self.sf*self.slope*self.B
-        self.sM_sub = np.sqrt(self.sM**2 + (self.sf*self.sigma_slope*self.B)**2)
+        with self.stage("substraction"):
+            self.M_sub, self.sM_sub = substract_linear_background(self.B, self.M,\
+                                          self.sM, self.slope, self.sf, self.sigma_slope)
 
     def print_log(self, entry):
         self.header += '#' + entry + '\n'
@@ -44,124 +91,65 @@ class VSM_Substract(VSMClass):
         #                   "measured with the same magnetic field steps.")
                               
     def load_bg(self):
-        B, M, sM, Mraw, sMraw, header = self.get_data_from_file(self.bg_path)
+        with self.stage("load"):
+            B, M, sM, Mraw, sMraw, header = self.get_data_from_file(self.bg_path)
         #load : self.bg_path
         self.B_bg = np.asarray(B)
         self.M_bg = np.asarray(M)
         self.sM_bg = np.asarray(sM)
+        self.idx_sorted_bg = None
+        self.branches_bg = find_sweep_branches(self.B_bg, sweep_tolerance(self.B_bg))
         
     def substract_ptbypt(self):
         self.compare_B_values(self.B, self.B_bg)
-        self.Binterpolated, self.Minterpolated, self.sMinterpolated,\
-            self.M_sub, self.sM_sub = self.nearest_point_substraction(\
-                              self.B, self.M, self.sM,\
-                              self.B_bg, self.sf*self.M_bg, self.sf*self.sM_bg)
+        with self.stage("substraction"):
+            self.Binterpolated, self.Minterpolated, self.sMinterpolated,\
+                self.M_sub, self.sM_sub = self.nearest_point_substraction(\
+                                  self.B, self.M, self.sM,\
+                                  self.B_bg, self.sf*self.M_bg, self.sf*self.sM_bg,\
+                                  self.idx_sorted_bg, self.branches, self.branches_bg)
 
     def nearest_point_substraction(self, B1, M1, sM1,\
-                                           B2, M2, sM2):
-        Binterpolated = []
-        Minterpolated = []
-        sMinterpolated = []
-
-        Msubstracted = []
-        sMsubstracted = []
-
-        NB2 = len(B2)
-        for iB, Bval in enumerate(B1):
-            # linear interpolation of B2 at Bval:
-            nearest_idx = self.find_idx_nearest_val(B2, Bval)
-            Bnear = B2[nearest_idx]
-            if np.allclose(Bnear, Bval):
-                M2_interpolated = M2[nearest_idx]
-                sM2_interpolated = sM2[nearest_idx]
-
-                Binterpolated.append(Bnear)
-                Minterpolated.append(M2_interpolated)
-                sMinterpolated.append(sM2_interpolated)
-
-                Msub = M1[iB] - M2_interpolated
-                Msubstracted.append(Msub)
-                sMsubstracted.append(np.sqrt(sM1[iB]**2 +\
-                                     sM2_interpolated**2))
-            else:
-                if nearest_idx == 0:
-                    high_idx = 1
-                    low_idx = 0
-                elif nearest_idx == NB2-1:
-                    high_idx = NB2-1
-                    low_idx = NB2-2
-                else:
-                    if Bnear < Bval:
-                        low_idx = nearest_idx
-                        high_idx = nearest_idx + 1
-                    else:
-                        low_idx = nearest_idx - 1
-                        high_idx = nearest_idx
-
-                dB = (B2[high_idx] - B2[low_idx])
-                slope = (M2[high_idx] - M2[low_idx])/dB
-                sig_slope = np.sqrt(sM2[high_idx]**2 + sM2[low_idx]**2)/dB
-
-                M2_interpolated = slope*(Bval - B2[low_idx]) + M2[low_idx]
-                sM2_interpolated = np.sqrt(sM2[low_idx]**2 +\
-                                           (sig_slope*(Bval - B2[low_idx]))**2)
-                Binterpolated.append(Bval)
-                Minterpolated.append(M2_interpolated)
-                sMinterpolated.append(sM2_interpolated)
-
-                Msub = M1[iB] - M2_interpolated
-                Msubstracted.append(Msub)
-                sMsubstracted.append(np.sqrt(sM1[iB]**2 +\
-                                     sM2_interpolated**2))
-
-        return np.asarray(Binterpolated),\
-                np.asarray(Minterpolated), np.asarray(sMinterpolated),\
-                np.asarray(Msubstracted), np.asarray(sMsubstracted)
+                                           B2, M2, sM2, idx_sorted2=None,\
+                                           branches1=None, branches2=None):
+        return nearest_point_substraction(B1, M1, sM1, B2, M2, sM2, idx_sorted2,\
+                                          branches1, branches2)
 
     def save_to_file_ptbypt(self):
-        save_data = open(self.save_to, "w")
-        save_data.write(self.header)
-        save_data.write("#Substracted file: " +self.sample_path+"\n")
-        save_data.write("#Background file: " + str(self.bg_path) + "\n")
-        save_data.write("#BG Scalefactor: " + str(self.sf) + "\n")
-        save_data.write('\n\n\n#Raw Background data:\n')
-        save_data.write("#B_bg / "+self.Bunit+\
-                        "\tM_bg / "+self.Munit+\
-                        "\tsM_bg / "+ self.Munit+"\n")
-        for i, bval in enumerate(self.B_bg):
-            save_data.write('#'+str(bval)+"\t"+\
-                            str(self.M_bg[i])+"\t"+\
-                            str(self.sM_bg[i])+"\n")
-        save_data.write('\n\n')
+        header = self.header
+        header += "#Substracted file: " +self.sample_path+"\n"
+        header += "#Background file: " + str(self.bg_path) + "\n"
+        header += "#BG Scalefactor: " + str(self.sf) + "\n"
+        header += '\n\n\n#Raw Background data:\n'
+        header += "#B_bg / "+self.Bunit+\
+                  "\tM_bg / "+self.Munit+\
+                  "\tsM_bg / "+ self.Munit+"\n"
+        header += self.format_columns([self.B_bg, self.M_bg, self.sM_bg],\
+                                      prefix="#")
+        header += '\n\n'
         
 
-        save_data.write("#B / "+self.Bunit+\
-                        "\tM_sub / "+self.Munit+\
-                        "\tsM_sub / "+ self.Munit+\
-                        "\tM_sample / "+self.Munit+\
-                        "\tsM_sample / "+ self.Munit+\
-                        "\tM_bg / "+self.Munit+\
-                        "\tsM_bg / "+ self.Munit+\
-                        "\tM_raw / "+self.Mrawunit+\
-                        "\tsM_raw / "+ self.Mrawunit+"\n")
-        for i, bval in enumerate(self.B):
-            save_data.write(str(bval)+"\t"+\
-                            str(self.M_sub[i])+"\t"+\
-                            str(self.sM_sub[i])+"\t"+\
-                            str(self.M[i])+"\t"+\
-                            str(self.sM[i])+"\t"+\
-                            str(self.Minterpolated[i])+"\t"+\
-                            str(self.sMinterpolated[i])+"\t"+\
-                            str(self.Mraw[i])+"\t"+\
-                            str(self.sMraw[i])+"\n")
-
-        save_data.close()
+        header += "#B / "+self.Bunit+\
+                  "\tM_sub / "+self.Munit+\
+                  "\tsM_sub / "+ self.Munit+\
+                  "\tM_sample / "+self.Munit+\
+                  "\tsM_sample / "+ self.Munit+\
+                  "\tM_bg / "+self.Munit+\
+                  "\tsM_bg / "+ self.Munit+\
+                  "\tM_raw / "+self.Mrawunit+\
+                  "\tsM_raw / "+ self.Mrawunit+"\n"
+        self.save_xye_file(self.save_to, header,\
+                           [self.B, self.M_sub, self.sM_sub, self.M, self.sM,\
+                            self.Minterpolated, self.sMinterpolated,\
+                            self.Mraw, self.sMraw])
 
     def plot_substraction_ptbypt(self):
         if self.Munit == "kAm-1":
             Munit = "kAm^{-1}"
         else:
             Munit = self.Munit
+        self.profiler.start_stage("plot")
+        plt = pyplot()
         fig, ax = plt.subplots()
         ax.axhline(0, color='black')
         ax.axvline(0, color='black')
@@ -182,39 +170,38 @@ class VSM_Substract(VSMClass):
         plt.legend(loc='best', fontsize=8).draw_frame(True)
 
         fig.savefig(self.plot_path)
-        plt.show()
+        self.profiler.end_stage()
+        if self.show_plots:
+            plt.show()
+        else:
+            plt.close(fig)
         
         
     def save_to_file_linear_substraction(self):
-        save_data = open(self.save_to, "w")
-        save_data.write(self.header)
-        save_data.write("#Substracted file: " +self.sample_path+"\n")
-        save_data.write("#Using Slope: " + str(self.slope) + "\n")
-        save_data.write("#BG Scalefactor: " + str(self.sf) + "\n")
-        save_data.write("#BG Sigma Slope: " + str(self.sigma_slope) + "\n")
+        header = self.header
+        header += "#Substracted file: " +self.sample_path+"\n"
+        header += "#Using Slope: " + str(self.slope) + "\n"
+        header += "#BG Scalefactor: " + str(self.sf) + "\n"
+        header += "#BG Sigma Slope: " + str(self.sigma_slope) + "\n"
         
-        save_data.write("#B / "+self.Bunit+\
-                        "\tM_sub / "+self.Munit+\
-                        "\tsM_sub / "+ self.Munit+\
-                        "\tM_extracted / "+self.Munit+\
-                        "\tsM_extracted / "+ self.Munit+\
-                        "\tM_raw / "+self.Mrawunit+\
-                        "\tsM_raw / "+ self.Mrawunit+"\n")
-        for i, bval in enumerate(self.B):
-            save_data.write(str(bval)+"\t"+\
-                            str(self.M_sub[i])+"\t"+\
-                            str(self.sM_sub[i])+"\t"+\
-                            str(self.M[i])+"\t"+\
-                            str(self.sM[i])+"\t"+\
-                            str(self.Mraw[i])+"\t"+\
-                            str(self.sMraw[i])+"\n")
-        save_data.close()
+        header += "#B / "+self.Bunit+\
+                  "\tM_sub / "+self.Munit+\
+                  "\tsM_sub / "+ self.Munit+\
+                  "\tM_extracted / "+self.Munit+\
+                  "\tsM_extracted / "+ self.Munit+\
+                  "\tM_raw / "+self.Mrawunit+\
+                  "\tsM_raw / "+ self.Mrawunit+"\n"
+        self.save_xye_file(self.save_to, header,\
+                           [self.B, self.M_sub, self.sM_sub, self.M, self.sM,\
+                            self.Mraw, self.sMraw])
 
     def plot_substraction_linear(self):
         if self.Munit == "kAm-1":
             Munit = "kAm^{-1}"
         else:
             Munit = self.Munit
+        self.profiler.start_stage("plot")
+        plt = pyplot()
         fig, ax = plt.subplots()
         ax.axhline(0, color='black')
         ax.axvline(0, color='black')
@@ -235,7 +222,11 @@ class VSM_Substract(VSMClass):
         plt.legend(loc='best', fontsize=8).draw_frame(True)
 
         fig.savefig(self.plot_path)
-        plt.show()
+        self.profiler.end_stage()
+        if self.show_plots:
+            plt.show()
+        else:
+            plt.close(fig)
         
     def help(self):
         print("python vsm_substract.py samplefile [SLOPE/SUBSTRACTFILE] [saveto] [..]")
@@ -246,9 +237,26 @@ class VSM_Substract(VSMClass):
         print("-sf \t -- \t Apply scale factor at substraction m = m_s - sf*m_bg")
         print("-sig SIGMASLOPE\t -- \t Increase error by systematic error.")
         print("-saveto SAVEPATH\t -- \t Save data to SAVEPATH.")
+        print("-noshow \t -- \t Only save the plot, no window (also --no-show).")
+        print("\nBatch mode:")
+        print("python vsm_substract.py -batch [SLOPE/SUBSTRACTFILE] SAMPLE [SAMPLE2 ...] [..]")
+        print("Samples can be given as glob patterns (e.g. \"*.xye\"). Plots are not shown.")
+        print("-sftable FILE \t -- \t Scale factor for each sample, lines of: samplefile sf")
+        print("-plot \t -- \t Save plot for each sample.")
+        print("-cache \t -- \t Keep binary copies of loaded .xye files for faster reloading.")
+        print("-prec N \t -- \t Write values with N significant digits.")
+        print("-profile \t -- \t Print wall time of each stage.")
+        print("-profile_memory \t -- \t Also trace peak memory, slows down the stages.")
+        print("-profile_report FILE \t -- \t Also save the profile as JSON.")
 
         
     def get_args(self):
+        self.idx_sorted_bg = None
+        self.batch_mode = "-batch" in sys.argv
+        if self.batch_mode:
+            self.get_batch_args()
+            return
+
         # Initialization:
         if self.n_args <= 1:
             print("Error: Usage of substract linear script:")
@@ -269,6 +277,22 @@ class VSM_Substract(VSMClass):
                 sys.exit()
                 
                 
+        self.set_sample_path(self.sample_path)
+        if "-saveto" in sys.argv:
+            self.save_to = sys.argv[sys.argv.index("-saveto") + 1]
+        
+        if "-sf" in sys.argv:
+            self.sf = float(sys.argv[sys.argv.index("-sf") + 1])
+        else:
+            self.sf = 1
+
+        if "-sig" in sys.argv:
+            self.sigma_slope = float(sys.argv[sys.argv.index("-sig") + 1])
+        else:
+            self.sigma_slope = 0.
+
+    def set_sample_path(self, sample_path):
+        self.sample_path = sample_path
         head, tail = os.path.split(self.sample_path)
         self.pre, ext = os.path.splitext(tail)
         if self.substract_pbp:
@@ -283,18 +307,55 @@ class VSM_Substract(VSMClass):
         
         if self.save_to.startswith("/"):
             self.save_to = "." + self.save_to
-        if "-saveto" in sys.argv:
-            self.save_to = sys.argv[sys.argv.index("-saveto") + 1]
-        
+
+    def get_batch_args(self):
+        ibatch = sys.argv.index("-batch")
+        if ibatch + 2 > self.n_args:
+            print("Error: Usage of batch substraction:")
+            self.help()
+            sys.exit()
+        background = sys.argv[ibatch + 1]
+        try:
+            self.slope = float(background)
+            self.substract_pbp = False
+        except ValueError:
+            if os.path.isfile(background):
+                self.bg_path = background
+                self.substract_pbp = True
+            else:
+                sys.exit("ERROR: Background must either be a number or a filepath.")
+
+        self.sample_list = []
+        jp = ibatch + 2
+        while jp <= self.n_args and not sys.argv[jp].startswith("-"):
+            matches = sorted(glob.glob(sys.argv[jp]))
+            if len(matches) == 0:
+                print("Could not find file: " + sys.argv[jp])
+            for sample_path in matches:
+                if not sample_path in self.sample_list and\
+                   sample_path != background:
+                    self.sample_list.append(sample_path)
+            jp += 1
+
         if "-sf" in sys.argv:
-            self.sf = float(sys.argv[sys.argv.index("-sf") + 1])
+            self.default_sf = float(sys.argv[sys.argv.index("-sf") + 1])
         else:
-            self.sf = 1
+            self.default_sf = 1
+        self.sf_table = {}
+        if "-sftable" in sys.argv:
+            sf_file = open(sys.argv[sys.argv.index("-sftable") + 1], "r")
+            for line in sf_file:
+                split_line = line.split('#')[0].strip().split()
+                if len(split_line) < 2:
+                    continue
+                self.sf_table[split_line[0]] = float(split_line[1])
+            sf_file.close()
 
         if "-sig" in sys.argv:
             self.sigma_slope = float(sys.argv[sys.argv.index("-sig") + 1])
         else:
             self.sigma_slope = 0.
+        self.plot_batch = "-plot" in sys.argv
 
 if __name__ == "__main__":
     VSM_Substract()